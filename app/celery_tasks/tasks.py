@@ -1,22 +1,109 @@
-import uuid
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
 
-from services.bedrock_embeddings import embed_texts
-from services.chunking import extract_content_from_url, flatten_markdown_chunks
-from services.qdrant import store_points
+import requests
+from celery import chord
+from config.config import settings
+from controllers.corpus_controller import update_corpus
+from db.pg_connection import SessionLocal
+from schemas.enums import ProcessingStatus
+from services.chunking import extract_content_from_url
+from services.crawler import discover_pages, fetch_sections
+from services.ingestion import index_sections
+from services.qdrant import filter_by_corpora, scroll_ids
 
 from .worker import app
 
+PAGES_PER_TASK = settings.crawl_pages_per_task
+CONNECTIONS_PER_HOST = settings.crawl_connections_per_host
+
+
+def index_page(url: str, corpus_id: str) -> Optional[int]:
+    """
+    Fetch and index a page of a crawled site.
+
+    A page that cannot be fetched, parsed or indexed is skipped, returning
+    None, so it does not fail the other pages of the corpus.
+    """
+    try:
+        return index_sections(fetch_sections(url), url, corpus_id)
+    except requests.RequestException as e:
+        print(f"Could not fetch {url}: {e}")
+    except Exception as e:
+        print(f"Could not index {url}: {e!r}")
+    return None
+
+
+def finish_corpus(corpus_id: str, status: ProcessingStatus):
+    """Update the status of a corpus, and its version once it is processed."""
+    version = None
+    if status == ProcessingStatus.processed:
+        # The point ids are derived from the content, so they identify it
+        ids = sorted(scroll_ids(filter_by_corpora([corpus_id])))
+        version = hashlib.sha256("".join(ids).encode()).hexdigest()
+    with SessionLocal() as db:
+        update_corpus(corpus_id, status, db, version)
+
 
 @app.task
-def process_documentation_task(url: str, chat_id: str):
+def process_documentation_task(url: str, corpus_id: str):
     """Task to process documentation."""
-    sections = extract_content_from_url(url)
-    chunks = flatten_markdown_chunks(sections, max_length=1024)
-    texts = [chunk["content"] for chunk in chunks]
-    vectors = embed_texts(texts)
-    ids = [str(uuid.uuid4()) for _ in chunks]
-    payloads = [
-        {"text": chunk["content"], "url": url, "chat_id": chat_id} for chunk in chunks
-    ]
-    n_documents = store_points(ids, payloads, vectors)
+    try:
+        sections = extract_content_from_url(url)
+        n_documents = index_sections(sections, url, corpus_id)
+    except Exception:
+        finish_corpus(corpus_id, ProcessingStatus.failed)
+        raise
+    finish_corpus(corpus_id, ProcessingStatus.processed)
     print(f"Indexed {n_documents}")
+
+
+@app.task(bind=True)
+def crawl_documentation_task(
+    self,
+    url: str,
+    corpus_id: str,
+    max_pages: Optional[int] = None,
+    max_depth: Optional[int] = None,
+):
+    """Task to discover the pages of a documentation site and index them."""
+    try:
+        pages = discover_pages(url, max_pages, max_depth)
+    except Exception:
+        finish_corpus(corpus_id, ProcessingStatus.failed)
+        raise
+    print(f"Discovered {len(pages)} pages from {url}")
+    batches = [
+        pages[i : i + PAGES_PER_TASK] for i in range(0, len(pages), PAGES_PER_TASK)
+    ]
+    # Fan out the pages across the workers. The crawl task is replaced by
+    # the chord, so its state tracks the indexing of every page.
+    callback = finish_corpus_task.s(corpus_id).on_error(fail_corpus_task.si(corpus_id))
+    raise self.replace(
+        chord((process_pages_task.s(batch, corpus_id) for batch in batches), callback)
+    )
+
+
+@app.task
+def process_pages_task(urls: List[str], corpus_id: str):
+    """Task to fetch and index a batch of pages concurrently."""
+    with ThreadPoolExecutor(max_workers=CONNECTIONS_PER_HOST) as executor:
+        counts = list(executor.map(lambda url: index_page(url, corpus_id), urls))
+    n_documents = sum(count for count in counts if count is not None)
+    n_skipped = counts.count(None)
+    print(f"Indexed {n_documents} from {len(urls)} pages, {n_skipped} skipped")
+    return n_documents
+
+
+@app.task
+def finish_corpus_task(counts: List[int], corpus_id: str):
+    """Task to mark a crawled corpus as processed."""
+    finish_corpus(corpus_id, ProcessingStatus.processed)
+    return sum(counts)
+
+
+@app.task
+def fail_corpus_task(corpus_id: str):
+    """Task to mark a crawled corpus as failed."""
+    finish_corpus(corpus_id, ProcessingStatus.failed)
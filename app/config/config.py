@@ -1,3 +1,6 @@
+from typing import Optional
+
+from pydantic import Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -23,12 +26,99 @@ class Settings(BaseSettings):
     # Qdrant
     collection_name: str
     qdrant_url: str
+    qdrant_prefer_grpc: bool = True
+    qdrant_upload_workers: int = 4
+    qdrant_batch_size: int = 256
+    qdrant_hnsw_m: int = 16
+    qdrant_hnsw_ef_construct: int = 100
+    qdrant_hnsw_payload_m: int = 16
+    qdrant_on_disk_payload: bool = True
 
     # Rag config
     max_chunks_retrieved: int
     max_chunks_reranked: int
-    default_chunk_size: int
-    default_chunk_overlap: int
+    # Dense and sparse search, skipping the rerank when their top k agree.
+    # The top k documents are then accepted without LLM grading, and the
+    # others graded, see rerank_accept_threshold
+    hybrid_search: bool = True
+    rerank_skip_top_k: int = 3
+    # Documents are accepted above and rejected below, without LLM grading
+    rerank_accept_threshold: float = 0.7
+    rerank_reject_threshold: float = 0.1
+    # Tokens of the chunks, split into pieces of at least one token
+    default_chunk_size: int = Field(gt=1)
+    default_chunk_overlap: int = Field(ge=0)
+    # Tokens of retrieved context in the generation prompts
+    context_token_budget: int = 3000
+    grading_mode: str = "listwise"
+    grading_concurrency: int = 8
+    rag_max_rewrites: int = 2
+    rag_max_regenerations: int = 2
+    rag_deadline_seconds: float = 45
+    # Return the answer of the RAG loop instead of generating it again
+    single_generation: bool = True
+    # Intent classifier (local, falling back to the LLM, or llm)
+    intent_classifier: str = "local"
+    intent_min_margin: float = 0.05
+
+    # Extraction (lxml or bs4)
+    html_backend: str = "lxml"
+
+    # Crawler
+    crawl_max_pages: int = 500
+    crawl_max_depth: int = 2
+    # Largest maxPages and maxDepth accepted in a request
+    crawl_pages_limit: int = 5000
+    crawl_depth_limit: int = 5
+    crawl_concurrency: int = 16
+    crawl_connections_per_host: int = 8
+    crawl_pages_per_task: int = 10
+
+    # Embeddings
+    embeddings_concurrency: int = 8
+    embeddings_dimension: Optional[int] = None
+    # Characters of the longest text the embeddings model accepts
+    embeddings_max_length: int = 2048
+
+    # Ingestion pipeline
+    ingestion_embed_workers: int = 4
+    ingestion_store_workers: int = 2
+    ingestion_queue_size: int = 4
+
+    # Embeddings cache
+    embeddings_cache_backend: str = "redis"
+    embeddings_cache_url: str = "redis://redis:6379/1"
+    embeddings_cache_path: str = "embeddings_cache.sqlite3"
+    embeddings_cache_max_entries: int = 100000
+
+    # Answer cache (redis or none)
+    answer_cache_backend: str = "redis"
+    answer_cache_url: str = "redis://redis:6379/2"
+    answer_cache_threshold: float = 0.95
+    answer_cache_ttl: int = 86400
+    answer_cache_max_entries: int = 500
+
+    # Messages per page of the chat history
+    chat_history_limit: int = 50
+    chat_history_max_limit: int = 500
+
+    # Conversation memory: window of recent turns and summary of the older ones
+    memory_token_budget: int = 1500
+    memory_summary_tokens: int = 1000
+    memory_max_messages: int = 50
+    memory_cache_backend: str = "redis"
+    memory_cache_url: str = "redis://redis:6379/3"
+    memory_cache_ttl: int = 604800
+
+    # Chat messages: written by a write-behind queue, or in a transaction
+    # before the answer is returned (write-behind or transaction)
+    message_durability: str = "write-behind"
+    message_queue_size: int = 1000
+    message_batch_size: int = 100
+    message_flush_interval: float = 0.2
+
+    # Threads for the blocking calls of the async endpoints
+    blocking_workers: int = 16
 
     # Rabbit
     rabbitmq_default_user: str
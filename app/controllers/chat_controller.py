@@ -1,36 +1,317 @@
+import json
+import uuid
+from typing import AsyncIterator, List, Optional, Tuple
+
+from config.config import settings
+from controllers.corpus_controller import get_chat_corpus_versions
+from db.pg_connection import SessionLocal
 from models.chat import Chat, Message
+from services.answer_cache import cache_answer, cache_scope, get_cached_answer
+from services.blocking import run_blocking
+from services.conversation_memory import (
+    get_summary,
+    memory_messages,
+    needs_summary,
+    save_summary,
+    split_window,
+    summarize,
+)
+from services.message_writer import pending_messages, save_exchange, utcnow
+from sqlalchemy import tuple_
 from sqlalchemy.orm import Session
-from workflows.graph import compiled_graph
-
-
-def query_documents(chat_id: str, message: str, db: Session):
-    """Function to query documents based on the chat ID and message."""
-    result = compiled_graph.invoke(
-        {
-            "question": message,
-            "chat_id": chat_id,
-            "documents": [],
-            "intent": None,
-            "answer": None,
-            "code": None,
-            "messages": [],
-        }
+from workflows.graph import ANSWER_TOKEN_EVENT, compiled_graph
+from workflows.ragflow import DRAFT_TOKEN_EVENT
+
+CHAT_HISTORY_LIMIT = settings.chat_history_limit
+MEMORY_MAX_MESSAGES = settings.memory_max_messages
+
+# Nodes generating an answer, replacing any draft streamed before
+ANSWER_NODES = {"generate", "generate_answer", "ask_clarification"}
+
+# Progress step reported when each node of the graphs starts
+PROGRESS_STEPS = {
+    "analyze_query": "classifying",
+    "prefetch_documents": "retrieving",
+    "retrieve": "retrieving",
+    "grade_documents": "grading",
+    "transform_query": "rewriting",
+    "generate": "generating",
+    "grade_generation": "checking",
+    "ask_clarification": "answering",
+    "generate_answer": "answering",
+}
+
+
+class ChatNotFoundError(Exception):
+    """The chat of a message does not exist."""
+
+
+def initial_state(chat_id: str, message: str, corpus_ids: list, messages: list) -> dict:
+    """Function to build the initial state of the query graph."""
+    return {
+        "question": message,
+        "chat_id": chat_id,
+        "corpus_ids": corpus_ids,
+        "documents": [],
+        "intent": None,
+        "answer": None,
+        "code": None,
+        "messages": messages,
+        "deadline": None,
+        "low_confidence": False,
+        "query_vector": None,
+        "prefetched": None,
+        "generation_grade": None,
+    }
+
+
+async def query_documents(chat_id: str, message: str):
+    """
+    Function to query documents based on the chat ID and message.
+
+    Returns the answer, and whether it is low-confidence because a budget of
+    the RAG loop was exhausted. Raises ChatNotFoundError if the chat does not
+    exist.
+
+    The session is only held to load the chat, not during the generation, so
+    the questions in flight do not hold a connection of the pool each.
+    """
+    asked_at = utcnow()
+    # The session is blocking, it is only used from the bounded executor
+    with SessionLocal() as db:
+        corpus_versions = await run_blocking(get_chat_corpus_versions, chat_id, db)
+        if corpus_versions is None:
+            raise ChatNotFoundError(chat_id)
+        messages = await load_memory(chat_id, db)
+    scope = cache_scope(chat_id, corpus_versions)
+    # Follow-up questions depend on the conversation, only the questions
+    # asked without memory are answered from the cache and added to it
+    use_cache = not messages
+    answer = None
+    if use_cache:
+        answer = await run_blocking(get_cached_answer, scope, message)
+    low_confidence = False
+    if answer is None:
+        state = initial_state(chat_id, message, list(corpus_versions), messages)
+        result = await compiled_graph.ainvoke(state)
+        answer = result.get('answer')
+        low_confidence = result.get('low_confidence', False)
+        if use_cache and is_cacheable(result):
+            await run_blocking(cache_answer, scope, message, answer)
+    await save_exchange(chat_id, message, answer, asked_at)
+    return answer, low_confidence
+
+
+async def stream_query_documents(chat_id: str, message: str) -> AsyncIterator[str]:
+    """
+    Function to query documents, streaming server-sent events.
+
+    Emits a 'progress' event when each step of the graph starts, a 'token'
+    event for each token of the answer and a final 'done' event with the whole
+    answer, once it is saved, and whether it is low-confidence, or an 'error'
+    event. A cached answer is sent as a single 'token' event.
+
+    The answers of the RAG loop are streamed before they are graded, as
+    'token' events marked as draft. If a draft is rejected, a 'discard' event
+    tells to drop the tokens streamed since the last 'discard', and they are
+    followed by the next answer. An answer cut by the deadline is discarded
+    the same way, and followed by the final answer.
+
+    Runs while the response is streamed, after the request session is closed,
+    so it opens its own sessions and does not hold them during the generation.
+    """
+    asked_at = utcnow()
+    result = {}
+    try:
+        with SessionLocal() as db:
+            corpus_versions = await run_blocking(get_chat_corpus_versions, chat_id, db)
+        if corpus_versions is None:
+            yield sse_event("error", {"detail": "Chat not found"})
+            return
+        scope = cache_scope(chat_id, corpus_versions)
+        with SessionLocal() as db:
+            messages = await load_memory(chat_id, db)
+        # Only the questions asked without memory use the cache
+        use_cache = not messages
+        answer = None
+        if use_cache:
+            answer = await run_blocking(get_cached_answer, scope, message)
+        if answer is not None:
+            yield sse_event("token", {"text": answer})
+        else:
+            corpus_ids = list(corpus_versions)
+            state = initial_state(chat_id, message, corpus_ids, messages)
+            streamed = []
+            draft = []
+            async for event in compiled_graph.astream_events(state, version="v2"):
+                kind = event["event"]
+                name = event["name"]
+                node = event.get("metadata", {}).get("langgraph_node")
+                if kind == "on_chain_start" and name == node:
+                    if name in ANSWER_NODES and draft:
+                        yield sse_event("discard", {})
+                        draft = []
+                    if name in PROGRESS_STEPS:
+                        yield sse_event("progress", {"step": PROGRESS_STEPS[name]})
+                elif kind == "on_custom_event" and name == DRAFT_TOKEN_EVENT:
+                    draft.append(event["data"])
+                    yield sse_event("token", {"text": event["data"], "draft": True})
+                elif kind == "on_custom_event" and name == ANSWER_TOKEN_EVENT:
+                    streamed.append(event["data"])
+                    yield sse_event("token", {"text": event["data"]})
+                elif kind == "on_chain_end" and not event.get("parent_ids"):
+                    result = event["data"]["output"]
+            answer = result.get("answer")
+            # Drafts are discarded when the answer generation starts
+            sent = "".join(streamed or draft)
+            if answer and sent.strip() != answer:
+                # Best answer of the RAG loop other than the last draft, or
+                # answer of a generation stopped by the deadline
+                if sent:
+                    yield sse_event("discard", {})
+                yield sse_event("token", {"text": answer})
+            if use_cache and is_cacheable(result):
+                await run_blocking(cache_answer, scope, message, answer)
+    except Exception as e:
+        print(f"Error streaming the answer: {e}")
+        yield sse_event("error", {"detail": "Error generating the answer"})
+        return
+    await save_exchange(chat_id, message, answer, asked_at)
+    low_confidence = result.get("low_confidence", False)
+    yield sse_event(
+        "done",
+        {"chat_id": chat_id, "message": answer, "low_confidence": low_confidence},
     )
-    answer = result.get('answer')
-    save_message(chat_id, {"role": "user", "content": message}, db)
-    save_message(chat_id, {"role": "assistant", "content": answer}, db)
-    return answer
-
-
-def get_chat_history(chat_id: str, db: Session):
-    """Function to get the chat history based on the chat ID."""
-    messages = (
-        db.query(Message)
-        .filter(Message.chat_id == chat_id)
-        .order_by(Message.created_at.desc())
+
+
+async def load_memory(chat_id: str, db: Session) -> list:
+    """
+    Function to load the memory of a chat, to prepend to the prompts.
+
+    The memory is the cached summary of the earlier turns and the window of
+    recent turns that fits in the memory token budget. Only the messages after
+    the summary are loaded, by keyset. The ones out of the window are added to
+    the summary in batches, so the memory stays about the same size however
+    long the chat is. Without the summary cache they are dropped.
+    """
+    summary, cursor, cached = await run_blocking(get_summary, chat_id)
+    messages = await run_blocking(
+        get_messages_after, chat_id, db, cursor, MEMORY_MAX_MESSAGES
+    )
+    # Saved by the write-behind queue, but maybe not yet written
+    loaded = {m["id"] for m in messages}
+    pending = [
+        m
+        for m in pending_messages(chat_id)
+        if m["id"] not in loaded
+        and (cursor is None or (m["created_at"], m["id"]) > cursor)
+    ]
+    if pending:
+        messages = sorted(
+            messages + pending,
+            key=lambda m: (m["created_at"], m["id"]),
+            reverse=True,
+        )[:MEMORY_MAX_MESSAGES]
+    older, window = split_window(messages)
+    if not cached:
+        # A summary could not be saved, and would be made again with every
+        # question, so the turns out of the window are dropped instead
+        older = []
+    elif needs_summary(older, len(messages) < MEMORY_MAX_MESSAGES):
+        # Return the connection to the pool while the model summarizes
+        await run_blocking(db.rollback)
+        try:
+            summary = await summarize(summary, older)
+            await run_blocking(save_summary, chat_id, summary, older[-1])
+        except Exception as e:
+            # Summarized again with the next question
+            print(f"Could not summarize the chat: {e}")
+        older = []
+    return memory_messages(summary, older + window)
+
+
+def is_cacheable(result: dict) -> bool:
+    """
+    Function to check whether an answer was validated: graded as useful by
+    the RAG loop, and not generated again after it.
+    """
+    return result.get("generation_grade") == "useful" and not result.get(
+        "low_confidence"
+    )
+
+
+def sse_event(event: str, data: dict) -> str:
+    """Function to format a server-sent event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def get_chat_history(
+    chat_id: str,
+    db: Session,
+    limit: int = CHAT_HISTORY_LIMIT,
+    before: Optional[uuid.UUID] = None,
+) -> Tuple[List[dict], Optional[uuid.UUID]]:
+    """
+    Function to get a page of the chat history, newest messages first.
+
+    The page is selected by keyset on the creation time and ID of the
+    messages, using the (chat_id, created_at, id) index, so its latency does
+    not depend on the length of the chat. Only the fields of the messages are
+    loaded, not ORM objects.
+
+    Args:
+        before: ID of the oldest message of the previous page
+
+    Returns:
+        the messages, and the ID to get the next page with, or None if it is
+        the last page
+    """
+    query = db.query(
+        Message.id, Message.role, Message.content, Message.created_at
+    ).filter(Message.chat_id == chat_id)
+    if before is not None:
+        created_at = (
+            db.query(Message.created_at)
+            .filter(Message.chat_id == chat_id, Message.id == before)
+            .scalar()
+        )
+        if created_at is None:
+            return [], None
+        query = query.filter(
+            tuple_(Message.created_at, Message.id) < tuple_(created_at, before)
+        )
+    rows = (
+        query.order_by(Message.created_at.desc(), Message.id.desc())
+        .limit(limit + 1)
         .all()
     )
-    return messages
+    messages = [row._asdict() for row in rows[:limit]]
+    next_before = messages[-1]["id"] if len(rows) > limit else None
+    return messages, next_before
+
+
+def get_messages_after(
+    chat_id: str,
+    db: Session,
+    after: Optional[Tuple] = None,
+    limit: Optional[int] = None,
+) -> List[dict]:
+    """
+    Function to get the newest messages of a chat, newest first.
+
+    Args:
+        after: creation time and ID of a message, to only get the messages
+            after it
+    """
+    query = db.query(
+        Message.id, Message.role, Message.content, Message.created_at
+    ).filter(Message.chat_id == chat_id)
+    if after is not None:
+        query = query.filter(tuple_(Message.created_at, Message.id) > tuple_(*after))
+    rows = (
+        query.order_by(Message.created_at.desc(), Message.id.desc()).limit(limit).all()
+    )
+    return [row._asdict() for row in rows]
 
 
 def create_chat(chat_id: str, url: str, db: Session):
@@ -40,14 +321,3 @@ def create_chat(chat_id: str, url: str, db: Session):
     db.commit()
     db.refresh(new_chat)
     return new_chat
-
-
-def save_message(chat_id: str, message: dict, db: Session):
-    """Function to save a message to the database."""
-    new_message = Message(
-        chat_id=chat_id, role=message.get('role'), content=message.get('content')
-    )
-    db.add(new_message)
-    db.commit()
-    db.refresh(new_message)
-    return new_message
@@ -0,0 +1,74 @@
+import uuid
+from typing import Dict, Optional
+
+from models.chat import Chat
+from models.corpus import Corpus
+from schemas.enums import ProcessingStatus
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+
+def get_corpus_id(url: str, crawl: bool) -> str:
+    """Function to get the id of the corpus of a URL, shared by every chat."""
+    mode = "crawl" if crawl else "page"
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{mode}:{url}"))
+
+
+def get_or_create_corpus(url: str, crawl: bool, db: Session) -> Corpus:
+    """Function to get the corpus of a URL, locked until commit, creating it if new."""
+    corpus_id = uuid.UUID(get_corpus_id(url, crawl))
+    corpus = db.query(Corpus).filter(Corpus.id == corpus_id).with_for_update().first()
+    if corpus is not None:
+        return corpus
+    try:
+        corpus = Corpus(
+            id=corpus_id,
+            url=url,
+            crawl=crawl,
+            status=ProcessingStatus.not_processed,
+        )
+        db.add(corpus)
+        db.flush()
+    except IntegrityError:
+        # Created at the same time by another request
+        db.rollback()
+        corpus = db.query(Corpus).filter(Corpus.id == corpus_id).with_for_update().one()
+    return corpus
+
+
+def add_corpus_to_chat(chat_id: str, corpus: Corpus, db: Session):
+    """Function to make a chat reference a corpus."""
+    chat = db.get(Chat, uuid.UUID(chat_id))
+    if chat is not None and corpus not in chat.corpora:
+        chat.corpora.append(corpus)
+
+
+def get_chat_corpus_versions(
+    chat_id: str, db: Session
+) -> Optional[Dict[str, Optional[str]]]:
+    """
+    Function to get the versions of the corpora referenced by a chat, by id.
+
+    Returns None if the chat does not exist.
+    """
+    chat = db.get(Chat, uuid.UUID(chat_id))
+    if chat is None:
+        return None
+    return {str(corpus.id): corpus.version for corpus in chat.corpora}
+
+
+def update_corpus(
+    corpus_id: str,
+    status: ProcessingStatus,
+    db: Session,
+    version: Optional[str] = None,
+):
+    """Function to update the processing status and version of a corpus."""
+    corpus = db.get(Corpus, uuid.UUID(corpus_id))
+    if corpus is None:
+        return None
+    corpus.status = status
+    if version is not None:
+        corpus.version = version
+    db.commit()
+    return corpus
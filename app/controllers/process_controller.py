@@ -2,21 +2,62 @@ import uuid
 
 from celery import states
 from celery.result import AsyncResult
-from celery_tasks.tasks import process_documentation_task
+from celery_tasks.tasks import crawl_documentation_task, process_documentation_task
 from celery_tasks.worker import app
-from controllers.chat_controller import create_chat
+from controllers.chat_controller import ChatNotFoundError, create_chat
+from controllers.corpus_controller import add_corpus_to_chat, get_or_create_corpus
+from models.chat import Chat
+from schemas.enums import ProcessingStatus
 from schemas.schemas import DocsInfo
 from sqlalchemy.orm import Session
 
 
 def process_documents(docs_info: DocsInfo, db: Session):
-    """Function to process documentation."""
-    chat_id = docs_info.chatId
-    if not chat_id:
+    """
+    Function to process documentation.
+
+    Raises ChatNotFoundError if the chat given does not exist.
+    """
+    if docs_info.chatId is None:
         chat_id = str(uuid.uuid4())
         chat_in_db = create_chat(chat_id, docs_info.url, db)
-    task_id = process_documentation_task.delay(docs_info.url, chat_id)
-    id = task_id.id
+    else:
+        chat_id = str(docs_info.chatId)
+        # Checked before the corpus is created and sent to be indexed
+        if db.get(Chat, docs_info.chatId) is None:
+            raise ChatNotFoundError(chat_id)
+    corpus = get_or_create_corpus(docs_info.url, docs_info.crawl, db)
+    add_corpus_to_chat(chat_id, corpus, db)
+    if not docs_info.refresh and corpus.status == ProcessingStatus.processed:
+        # Already indexed for another chat, nothing to embed
+        db.commit()
+        return {
+            "task_id": corpus.task_id,
+            "chat_id": chat_id,
+            "status": str(states.SUCCESS),
+        }
+    if not docs_info.refresh and corpus.status == ProcessingStatus.processing:
+        # Being indexed for another chat, follow the same task
+        db.commit()
+        return {
+            "task_id": corpus.task_id,
+            "chat_id": chat_id,
+            "status": get_task_status(corpus.task_id)["status"],
+        }
+    # The task id is saved before sending the task, so the task never
+    # finishes before the corpus is marked as processing
+    id = str(uuid.uuid4())
+    corpus.task_id = id
+    corpus.status = ProcessingStatus.processing
+    db.commit()
+    corpus_id = str(corpus.id)
+    if docs_info.crawl:
+        crawl_documentation_task.apply_async(
+            (docs_info.url, corpus_id, docs_info.maxPages, docs_info.maxDepth),
+            task_id=id,
+        )
+    else:
+        process_documentation_task.apply_async((docs_info.url, corpus_id), task_id=id)
     return {"task_id": id, "chat_id": chat_id, "status": str(states.PENDING)}
 
 
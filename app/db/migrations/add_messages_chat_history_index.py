@@ -0,0 +1,47 @@
+"""
+One-off migration: index of the chat history pages on the messages table.
+
+Usage, once, on databases created before the index:
+    docker compose exec app python app/db/migrations/add_messages_chat_history_index.py
+
+create_all only creates the index with the messages table, so existing
+databases need this migration. The index is built with CREATE INDEX
+CONCURRENTLY, which does not block the writes to the table, so it can run
+while the API is serving. A build that fails leaves an invalid index, which
+is dropped and built again on the next run.
+"""
+
+from db.pg_connection import engine
+from sqlalchemy import text
+
+INDEX_NAME = "ix_messages_chat_id_created_at"
+
+
+def migrate(bind=engine):
+    """Function to create the chat history index if it does not exist."""
+    # CONCURRENTLY cannot run inside a transaction
+    with bind.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        valid = conn.execute(
+            text(
+                "SELECT i.indisvalid FROM pg_index i "
+                "JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"
+            ),
+            {"name": INDEX_NAME},
+        ).scalar()
+        if valid:
+            print(f"Index {INDEX_NAME} already exists")
+            return
+        if valid is not None:
+            print(f"Dropping invalid index {INDEX_NAME}")
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {INDEX_NAME}"))
+        print(f"Creating index {INDEX_NAME}")
+        conn.execute(
+            text(
+                f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {INDEX_NAME} "
+                "ON messages (chat_id, created_at, id)"
+            )
+        )
+
+
+if __name__ == "__main__":
+    migrate()
@@ -1,11 +1,30 @@
-from fastapi import FastAPI
-from routers import process_router, chat_router
+from contextlib import asynccontextmanager
+
 from db.pg_connection import Base, engine
+from fastapi import FastAPI
+from routers import chat_router, metrics_router, process_router
+from services.bedrock_embeddings import embeddings_dimension
+from services.message_writer import message_writer
+from services.qdrant import ensure_collection
+
 
-api = FastAPI()
+@asynccontextmanager
+async def lifespan(api: FastAPI):
+    # Write the queued chat messages before shutting down
+    message_writer.start()
+    yield
+    await message_writer.stop()
+
+
+api = FastAPI(lifespan=lifespan)
 
 api.include_router(process_router.router)
 api.include_router(chat_router.router)
+api.include_router(metrics_router.router)
 
-# Create the database tables if they do not exist
+# Create the database tables if they do not exist. The indexes added to
+# tables that already existed are created by the migrations in db/migrations
 Base.metadata.create_all(bind=engine)
+
+# Create the Qdrant collection and its payload indexes if they do not exist
+ensure_collection(embeddings_dimension())
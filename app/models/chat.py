@@ -1,8 +1,9 @@
 import uuid
 
 from db.pg_connection import Base
+from models.corpus import chat_corpora
 from schemas.enums import ProcessingStatus
-from sqlalchemy import Column, DateTime, Enum, ForeignKey, String, func
+from sqlalchemy import Column, DateTime, Enum, ForeignKey, Index, String, func
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import relationship
 
@@ -15,10 +16,15 @@ class Chat(Base):
     url = Column(String, nullable=False)
     status = Column(Enum(ProcessingStatus), default=ProcessingStatus.not_processed)
     messages = relationship("Message", back_populates="chat")
+    corpora = relationship("Corpus", secondary=chat_corpora, back_populates="chats")
 
 
 class Message(Base):
     __tablename__ = "messages"
+    # Pages of the history of a chat, see chat_controller.get_chat_history
+    __table_args__ = (
+        Index("ix_messages_chat_id_created_at", "chat_id", "created_at", "id"),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     chat_id = Column(UUID(as_uuid=True), ForeignKey("chats.id"), nullable=False)
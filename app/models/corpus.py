@@ -0,0 +1,28 @@
+import uuid
+
+from db.pg_connection import Base
+from schemas.enums import ProcessingStatus
+from sqlalchemy import Boolean, Column, DateTime, Enum, ForeignKey, String, Table, func
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.orm import relationship
+
+chat_corpora = Table(
+    "chat_corpora",
+    Base.metadata,
+    Column("chat_id", UUID(as_uuid=True), ForeignKey("chats.id"), primary_key=True),
+    Column("corpus_id", UUID(as_uuid=True), ForeignKey("corpora.id"), primary_key=True),
+)
+
+
+class Corpus(Base):
+    __tablename__ = "corpora"
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    created_at = Column(DateTime, default=func.now())
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+    url = Column(String, nullable=False)
+    crawl = Column(Boolean, nullable=False, default=False)
+    version = Column(String, nullable=True)
+    task_id = Column(String, nullable=True)
+    status = Column(Enum(ProcessingStatus), default=ProcessingStatus.not_processed)
+    chats = relationship("Chat", secondary=chat_corpora, back_populates="corpora")
@@ -1,21 +1,64 @@
+import uuid
+from typing import Optional
+
+from config.config import settings
 from controllers import chat_controller
 from db.pg_connection import get_db
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
 from schemas.schemas import Message
+from services.answer_cache import cache_stats
 from sqlalchemy.orm import Session
 
+CHAT_HISTORY_LIMIT = settings.chat_history_limit
+CHAT_HISTORY_MAX_LIMIT = settings.chat_history_max_limit
+
 router = APIRouter(prefix="/api/v1", tags=["chat"])
 
 
 @router.post("/chat/{chatId}")
-async def send_message(chatId: str, msg: Message, db: Session = Depends(get_db)):
+async def send_message(chatId: uuid.UUID, msg: Message):
     """Endpoint to send a message to a chat."""
-    answer = chat_controller.query_documents(chatId, msg.message, db)
-    return {"chat_id": chatId, "message": answer}
+    chat_id = str(chatId)
+    try:
+        answer, low_confidence = await chat_controller.query_documents(
+            chat_id, msg.message
+        )
+    except chat_controller.ChatNotFoundError:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    return {"chat_id": chat_id, "message": answer, "low_confidence": low_confidence}
+
+
+@router.post("/chat/{chatId}/stream")
+async def stream_message(chatId: uuid.UUID, msg: Message):
+    """Endpoint to send a message to a chat, streaming the answer as events."""
+    return StreamingResponse(
+        chat_controller.stream_query_documents(str(chatId), msg.message),
+        media_type="text/event-stream",
+        # Disable the buffering of reverse proxies
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @router.get("/chat-history/{chatId}")
-async def get_chat_history(chatId: str, db: Session = Depends(get_db)):
-    """Endpoint to get the chat history."""
-    messages = chat_controller.get_chat_history(chatId, db)
-    return {"chat_id": chatId, "messages": messages}
+def get_chat_history(
+    chatId: uuid.UUID,
+    limit: int = Query(CHAT_HISTORY_LIMIT, ge=1, le=CHAT_HISTORY_MAX_LIMIT),
+    before: Optional[uuid.UUID] = None,
+    db: Session = Depends(get_db),
+):
+    """
+    Endpoint to get a page of the chat history, newest messages first.
+
+    The next page is requested with `before` set to the returned `next_before`,
+    which is null on the last page.
+    """
+    chat_id = str(chatId)
+    messages, next_before = chat_controller.get_chat_history(chat_id, db, limit, before)
+    return {"chat_id": chat_id, "messages": messages, "next_before": next_before}
+
+
+@router.get("/answer-cache/stats")
+def get_answer_cache_stats():
+    """Endpoint to get the hit rate of the answer cache."""
+    return cache_stats()
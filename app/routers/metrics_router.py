@@ -0,0 +1,10 @@
+from fastapi import APIRouter
+from services.metrics import snapshot
+
+router = APIRouter(prefix="/api/v1", tags=["metrics"])
+
+
+@router.get("/metrics")
+def get_metrics():
+    """Endpoint to get the counters of the process metrics."""
+    return snapshot()
@@ -1,11 +1,20 @@
-from typing import Literal, Optional
+import uuid
+from typing import List, Literal, Optional
 
+from config.config import settings
 from pydantic import BaseModel, Field
 
+CRAWL_PAGES_LIMIT = settings.crawl_pages_limit
+CRAWL_DEPTH_LIMIT = settings.crawl_depth_limit
+
 
 class DocsInfo(BaseModel):
     url: str
-    chatId: Optional[str] = None
+    chatId: Optional[uuid.UUID] = None
+    crawl: bool = False
+    maxPages: Optional[int] = Field(None, ge=1, le=CRAWL_PAGES_LIMIT)
+    maxDepth: Optional[int] = Field(None, ge=1, le=CRAWL_DEPTH_LIMIT)
+    refresh: bool = False
 
 
 class Message(BaseModel):
@@ -40,6 +49,23 @@ class GradeDocuments(BaseModel):
     )
 
 
+class DocumentGrade(BaseModel):
+    """Binary score for relevance check on one of the retrieved documents."""
+
+    index: int = Field(description="Index of the document in the list")
+    binary_score: str = Field(
+        description="Document is relevant to the question, 'yes' or 'no'"
+    )
+
+
+class GradeDocumentsList(BaseModel):
+    """Binary scores for relevance check on a list of retrieved documents."""
+
+    grades: List[DocumentGrade] = Field(
+        description="One grade for each document of the list"
+    )
+
+
 class GradeHallucinations(BaseModel):
     """Binary score for hallucination present in generation answer."""
 
@@ -54,3 +80,16 @@ class GradeAnswer(BaseModel):
     binary_score: str = Field(
         description="Answer addresses the question, 'yes' or 'no'"
     )
+
+
+class GradeGeneration(BaseModel):
+    """Binary scores for hallucination and relevance of a generation answer."""
+
+    grounded: str = Field(description="Answer is grounded in the facts, 'yes' or 'no'")
+    grounded_reason: str = Field(description="Short reason of the grounded score")
+    addresses_question: str = Field(
+        description="Answer addresses the question, 'yes' or 'no'"
+    )
+    addresses_question_reason: str = Field(
+        description="Short reason of the addresses question score"
+    )
@@ -1,4 +1,4 @@
-from typing import TypedDict, List, Dict, Optional
+from typing import Dict, List, Optional, TypedDict
 
 
 class QueryState(TypedDict):
@@ -8,19 +8,33 @@ class QueryState(TypedDict):
     Attributes:
         question: user's question
         chat_id: chat id
+        corpus_ids: ids of the corpora referenced by the chat
         documents: list of documents
         intent: intent of the question
         answer: generated answer
         code: code
-        messages: list of messages
+        messages: memory of the chat, see services.conversation_memory, and
+            the question
+        deadline: monotonic time by which the answer must be generated
+        low_confidence: whether a budget was exhausted before a valid answer
+        query_vector: embedding of the question
+        prefetched: documents retrieved for a question before its routing
+        generation_grade: grade of the answer by the RAG loop, None if the
+            answer was not graded
     """
     question: str
     chat_id: str
+    corpus_ids: List[str]
     documents: Optional[List[Dict]]
     intent: Optional[str]
     answer: Optional[str]
     code: Optional[str]
     messages: List[Dict]
+    deadline: Optional[float]
+    low_confidence: bool
+    query_vector: Optional[List[float]]
+    prefetched: Optional[Dict]
+    generation_grade: Optional[str]
 
 
 class RagState(TypedDict):
@@ -28,11 +42,34 @@ class RagState(TypedDict):
     Represents the state of the rag graph.
 
     Attributes:
+        chat_id: chat id
+        corpus_ids: ids of the corpora referenced by the chat
         question: user's question
         answer: generated answer
         documents: list of documents
+        messages: memory of the chat and the question
+        context: context of the prompt of the generation
+        deadline: monotonic time by which the answer must be generated
+        rewrites: number of rewrites of the question
+        regenerations: number of generations after the first one
+        generation_grade: grade of the last generation
+        best_answer: best graded generation so far
+        best_grade: grade of the best generation so far
+        low_confidence: whether a budget was exhausted before a valid answer
+        prefetched: documents retrieved for a question before its routing
     """
     chat_id: str
+    corpus_ids: List[str]
     question: str
     answer: str
     documents: Optional[List[Dict]]
+    messages: List[Dict]
+    context: Optional[str]
+    deadline: Optional[float]
+    rewrites: int
+    regenerations: int
+    generation_grade: Optional[str]
+    best_answer: Optional[str]
+    best_grade: Optional[str]
+    low_confidence: bool
+    prefetched: Optional[Dict]
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import time
+import uuid
+from typing import Dict, List, Optional
+
+import redis
+from config.config import settings
+from services.bedrock_embeddings import embed_query
+from services.embeddings_cache import decode, encode
+from services.vectors import normalize, similarity
+
+CACHE_BACKEND = settings.answer_cache_backend
+CACHE_URL = settings.answer_cache_url
+SIMILARITY_THRESHOLD = settings.answer_cache_threshold
+TTL = settings.answer_cache_ttl
+MAX_ENTRIES = settings.answer_cache_max_entries
+KEY_PREFIX = "answer:"
+LRU_PREFIX = "answer-lru:"
+STATS_KEY = "answer-stats"
+
+
+def cache_scope(chat_id: str, corpus_versions: Dict[str, Optional[str]]) -> str:
+    """
+    Get the cache scope of the answers of a chat.
+
+    Chats sharing the same corpora share their answers. The scope includes
+    the version of each corpus, so re-indexing a corpus with new content
+    invalidates its answers, which then expire.
+    """
+    if not corpus_versions:
+        # Chat indexed before corpora were shared
+        return f"chat:{chat_id}"
+    content = "|".join(
+        f"{id}:{version}" for id, version in sorted(corpus_versions.items())
+    )
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+class AnswerCache:
+    """
+    Semantic cache of validated answers, stored in Redis.
+
+    Each scope keeps its answers in a hash, with the question embeddings, and
+    their access times in a sorted set, to evict the least recently used.
+    Both keys expire after the TTL without new answers, and entries older
+    than the TTL are ignored.
+    """
+
+    def __init__(self, url: str, max_entries: int, ttl: int):
+        self.client = redis.Redis.from_url(url)
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+    def get(self, scope: str, vector: List[float], threshold: float):
+        entries = self.client.hgetall(KEY_PREFIX + scope)
+        now = time.time()
+        best_id, best_entry, best_score = None, None, threshold
+        for id, value in entries.items():
+            entry = json.loads(value)
+            if now - entry["created"] > self.ttl:
+                continue
+            score = similarity(vector, decode(bytes.fromhex(entry["vector"])))
+            if score >= best_score:
+                best_id, best_entry, best_score = id, entry, score
+        if best_entry is None:
+            return None
+        self.client.zadd(LRU_PREFIX + scope, {best_id: now})
+        return best_entry
+
+    def set(self, scope: str, vector: List[float], question: str, answer: str):
+        now = time.time()
+        id = uuid.uuid4().hex
+        entry = {
+            "question": question,
+            "answer": answer,
+            "vector": encode(vector).hex(),
+            "created": now,
+        }
+        pipeline = self.client.pipeline()
+        pipeline.hset(KEY_PREFIX + scope, id, json.dumps(entry))
+        pipeline.zadd(LRU_PREFIX + scope, {id: now})
+        pipeline.expire(KEY_PREFIX + scope, self.ttl)
+        pipeline.expire(LRU_PREFIX + scope, self.ttl)
+        pipeline.zcard(LRU_PREFIX + scope)
+        size = pipeline.execute()[-1]
+        if size > self.max_entries:
+            evicted = self.client.zpopmin(LRU_PREFIX + scope, size - self.max_entries)
+            self.client.hdel(KEY_PREFIX + scope, *[key for key, _ in evicted])
+
+    def count(self, field: str):
+        self.client.hincrby(STATS_KEY, field, 1)
+
+    def stats(self) -> Dict[str, int]:
+        values = self.client.hgetall(STATS_KEY)
+        return {key.decode(): int(value) for key, value in values.items()}
+
+
+def create_cache():
+    """Create the answer cache for the configured backend."""
+    if CACHE_BACKEND == "redis":
+        return AnswerCache(CACHE_URL, MAX_ENTRIES, TTL)
+    return None
+
+
+cache = create_cache()
+
+
+def get_cached_answer(scope: str, question: str) -> Optional[str]:
+    """Get the answer of a similar question of the scope, if it is cached."""
+    if cache is None:
+        return None
+    try:
+        vector = normalize(embed_query(question)[0])
+        entry = cache.get(scope, vector, SIMILARITY_THRESHOLD)
+        cache.count("hits" if entry else "misses")
+    except redis.RedisError as e:
+        print(f"Answer cache unavailable: {e}")
+        return None
+    if entry is None:
+        return None
+    print(f"Answer cache hit for {question!r}: {entry['question']!r}")
+    return entry["answer"]
+
+
+def cache_answer(scope: str, question: str, answer: str):
+    """Cache the validated answer of a question of the scope."""
+    if cache is None or not answer:
+        return
+    try:
+        # The question embedding is served from the embeddings cache
+        vector = normalize(embed_query(question)[0])
+        cache.set(scope, vector, question, answer)
+    except redis.RedisError as e:
+        print(f"Answer cache unavailable: {e}")
+
+
+def cache_stats() -> dict:
+    """Get the hits and misses of the answer cache, and its hit rate."""
+    if cache is None:
+        return {"enabled": False}
+    try:
+        stats = cache.stats()
+    except redis.RedisError as e:
+        print(f"Answer cache unavailable: {e}")
+        return {"enabled": True}
+    hits, misses = stats.get("hits", 0), stats.get("misses", 0)
+    total = hits + misses
+    return {
+        "enabled": True,
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / total if total else 0.0,
+    }
@@ -1,15 +1,27 @@
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Optional
 
 import boto3
 import cohere_aws
 from config.config import settings
+from services.embeddings_cache import cached_embeddings
+from services.throttling import AdaptiveLimiter, call_with_backoff
 
 REGION_NAME = settings.aws_region
 EMBEDDINGS_MODEL = settings.aws_embeddings_model
 BATCH_SIZE = 96
+# Max length allowed by embeddings model, see chunking.iter_token_chunks
+MAX_LENGTH = settings.embeddings_max_length
 RERANK_MODEL = settings.aws_rerank_model
 RERANK_REGION_NAME = settings.aws_rerank_region
 MAX_CHUNKS_RERANKED = settings.max_chunks_reranked
+EMBEDDINGS_CONCURRENCY = settings.embeddings_concurrency
+# Dimensions of the Cohere embeddings models available in Bedrock
+EMBEDDINGS_DIMENSIONS = {
+    'cohere.embed-english-v3': 1024,
+    'cohere.embed-multilingual-v3': 1024,
+    'cohere.embed-v4:0': 1536,
+}
 
 
 RERANK_MODEL_ARN = (
@@ -18,39 +30,75 @@ RERANK_MODEL_ARN = (
 
 client = cohere_aws.Client(mode=cohere_aws.Mode.BEDROCK, region_name=REGION_NAME)
 rerank_client = boto3.client('bedrock-agent-runtime', region_name=RERANK_REGION_NAME)
+# Shared by every embedding call of the process, so concurrent tasks and
+# requests back off together when Bedrock pushes back
+limiter = AdaptiveLimiter(EMBEDDINGS_CONCURRENCY)
+
+
+def embeddings_dimension() -> int:
+    """Get the dimension of the vectors of the embeddings model."""
+    if settings.embeddings_dimension:
+        return settings.embeddings_dimension
+    if EMBEDDINGS_MODEL in EMBEDDINGS_DIMENSIONS:
+        return EMBEDDINGS_DIMENSIONS[EMBEDDINGS_MODEL]
+    # Unknown model, ask it
+    return len(embed_batch(['dimension'], 'search_query')[0])
 
 
 def embed_texts(texts: List[str], batch_size: Optional[int] = BATCH_SIZE):
     """Embed a list of texts."""
-    # Max length allowed by embeddings model
-    MAX_LENGTH = 2048
     texts = [t[:MAX_LENGTH] for t in texts]
+    return cached_embeddings(
+        texts, 'search_document', lambda misses: embed_in_batches(misses, batch_size)
+    )
+
+
+def embed_in_batches(texts: List[str], batch_size: Optional[int] = BATCH_SIZE):
+    """Embed a list of texts, in batches of the given size."""
     n = max(1, batch_size)
     batches = [texts[i : i + n] for i in range(0, len(texts), n)]
     embeddings = []
-    for batch in batches:
-        batch_embeddings = embed_batch(batch)
-        embeddings.extend(batch_embeddings)
+    # Batches are sent in parallel, map keeps them in order
+    with ThreadPoolExecutor(max_workers=EMBEDDINGS_CONCURRENCY) as executor:
+        for batch_embeddings in executor.map(embed_batch_with_backoff, batches):
+            embeddings.extend(batch_embeddings)
     return embeddings
 
 
-def embed_batch(batch: List[str]):
+def embed_batch_with_backoff(batch: List[str], input_type: str = 'search_document'):
+    """Embed a batch of texts, backing off while Bedrock throttles the calls."""
+    return call_with_backoff(lambda: embed_batch(batch, input_type), limiter)
+
+
+def embed_batch(batch: List[str], input_type: str = 'search_document'):
     """Embed a batch of texts."""
     doc_embs = client.embed(
-        texts=batch, model_id=EMBEDDINGS_MODEL, input_type='search_document'
+        texts=batch, model_id=EMBEDDINGS_MODEL, input_type=input_type
     ).embeddings
     return doc_embs
 
 
 def embed_query(text: str):
     """Embed a query."""
-    texts = [text[:2048]]
-    query_embs = client.embed(
-        texts=texts, model_id=EMBEDDINGS_MODEL, input_type='search_query'
-    ).embeddings
+    texts = [text[:MAX_LENGTH]]
+    query_embs = cached_embeddings(
+        texts,
+        'search_query',
+        lambda misses: embed_batch_with_backoff(misses, 'search_query'),
+    )
     return query_embs
 
 
+def embed_queries(texts: List[str]):
+    """Embed a list of queries, at most a batch."""
+    texts = [text[:MAX_LENGTH] for text in texts]
+    return cached_embeddings(
+        texts,
+        'search_query',
+        lambda misses: embed_batch_with_backoff(misses, 'search_query'),
+    )
+
+
 def rerank_texts(query, texts, limit: Optional[int] = MAX_CHUNKS_RERANKED):
     """Rerank a list of texts."""
     print(f"Reranking {len(texts)} texts with limit {limit}")
@@ -1,9 +1,10 @@
-from typing import List, Optional
+from typing import AsyncIterator, List, Optional
 
 import boto3
 import litellm
 from config.config import settings
 from schemas.schemas import Message
+from services.metrics import increment
 
 REGION = settings.aws_region
 ACCESS_KEY = settings.aws_access_key_id
@@ -38,3 +39,64 @@ def query_model(
     )
     aws_answer = response.choices[0].message.content
     return aws_answer
+
+
+async def aquery_model(
+    messages: List[Message],
+    temperature: Optional[float] = TEMPERATURE,
+    tokens: Optional[int] = TOKENS,
+) -> str:
+    """Query a Large Language Model, without blocking the event loop."""
+    response = await litellm.acompletion(
+        model=AWS_MODEL,
+        api_base=litellm.api_base,
+        messages=messages,
+        aws_access_key_id=ACCESS_KEY,
+        aws_secret_access_key=SECRET_KEY,
+        aws_region_name=REGION,
+        temperature=temperature,
+        max_tokens=tokens,
+        drop_params=True,
+    )
+    count_usage(response.usage)
+    aws_answer = response.choices[0].message.content
+    return aws_answer
+
+
+async def astream_model(
+    messages: List[Message],
+    temperature: Optional[float] = TEMPERATURE,
+    tokens: Optional[int] = TOKENS,
+) -> AsyncIterator[str]:
+    """Query a Large Language Model, yielding the answer as it is generated."""
+    response = await litellm.acompletion(
+        model=AWS_MODEL,
+        api_base=litellm.api_base,
+        messages=messages,
+        aws_access_key_id=ACCESS_KEY,
+        aws_secret_access_key=SECRET_KEY,
+        aws_region_name=REGION,
+        temperature=temperature,
+        max_tokens=tokens,
+        drop_params=True,
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+    usage = None
+    async for chunk in response:
+        # The last chunk carries the usage of the whole stream
+        usage = getattr(chunk, "usage", None) or usage
+        if not chunk.choices:
+            continue
+        token = chunk.choices[0].delta.content
+        if token:
+            yield token
+    count_usage(usage)
+
+
+def count_usage(usage):
+    """Count an LLM call and its tokens in the process metrics."""
+    increment("llm_calls")
+    if usage:
+        increment("llm_prompt_tokens", usage.prompt_tokens or 0)
+        increment("llm_completion_tokens", usage.completion_tokens or 0)
@@ -0,0 +1,20 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from config.config import settings
+
+BLOCKING_WORKERS = settings.blocking_workers
+
+# Shared by every request of the process, so blocking clients (boto3, Redis,
+# SQLAlchemy) never run on the event loop and never use more than a bounded
+# number of threads
+executor = ThreadPoolExecutor(
+    max_workers=BLOCKING_WORKERS, thread_name_prefix="blocking"
+)
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking function in the bounded executor and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
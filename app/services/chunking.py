@@ -1,34 +1,165 @@
+import re
+from urllib.parse import urldefrag, urljoin
+
+import lxml.html
 import requests
 from bs4 import BeautifulSoup
+from config.config import settings
+
+HTML_BACKEND = settings.html_backend
+DEFAULT_CHUNK_SIZE = settings.default_chunk_size
+DEFAULT_CHUNK_OVERLAP = settings.default_chunk_overlap
+EMBEDDINGS_MAX_LENGTH = settings.embeddings_max_length
+# Words and symbols, a close estimate of the tokens of the embeddings model
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+HEADINGS = ["h1", "h2", "h3", "h4", "h5", "h6"]
+REMOVED_TAGS = ["script", "style", "noscript", "header", "footer", "nav", "aside"]
+CONTENT_TAGS = HEADINGS + ["p", "ul", "ol", "pre", "code"]
+HTML_PARSER = lxml.html.HTMLParser(encoding="utf-8", remove_comments=True)
 
 
 def extract_content_from_url(url):
-    """Extracts content from a URL."""
+    """Extracts content from a URL, yielding its sections."""
     response = requests.get(url)
     response.raise_for_status()
-    soup = BeautifulSoup(response.text, "html.parser")
+    yield from extract_content_from_html(response.text)
+
+
+def extract_content_from_html(html, backend=HTML_BACKEND):
+    """Extracts the sections of a page with the given backend, 'lxml' or 'bs4'."""
+    if backend == "bs4":
+        return extract_content_from_soup(BeautifulSoup(html, "html.parser"))
+    return extract_content_from_tree(parse_tree(html))
+
+
+def extract_links_from_html(html, base_url, backend=HTML_BACKEND):
+    """Extracts the absolute URLs linked from a page with the given backend."""
+    if backend == "bs4":
+        return extract_links_from_soup(BeautifulSoup(html, "html.parser"), base_url)
+    return extract_links_from_tree(parse_tree(html), base_url)
+
+
+def parse_tree(html):
+    """Parses a page with lxml."""
+    if not html.strip():
+        return None
+    return lxml.html.document_fromstring(html.encode("utf-8"), parser=HTML_PARSER)
 
+
+def extract_content_from_tree(root):
+    """
+    Extracts the sections of a page parsed by lxml, in a single pass.
+
+    Content elements are not descended into, so nested lists, paragraphs in
+    list items or code inside pre blocks are only emitted once, as part of
+    their outermost element.
+    """
+    current_section = None
+    for elem in iter_content_elements(root):
+        child = element_to_dict(elem)
+        if child is None:
+            continue
+        if child["type"] in HEADINGS:
+            # New heading, the previous section is complete
+            if current_section is not None:
+                yield current_section
+            current_section = child
+        elif current_section is not None:
+            # Add to the children of the closest heading
+            current_section["children"].append(child)
+        else:
+            # If there is no previous heading, add as root section
+            yield child
+
+    if current_section is not None:
+        yield current_section
+
+
+def iter_content_elements(root):
+    """Yields the outermost content elements of a tree, in document order."""
+    if root is None:
+        return
+    # Explicit stack instead of recursion, pages can be deeply nested
+    stack = [iter(root)]
+    while stack:
+        elem = next(stack[-1], None)
+        if elem is None:
+            stack.pop()
+        elif not isinstance(elem.tag, str) or elem.tag in REMOVED_TAGS:
+            continue
+        elif elem.tag in CONTENT_TAGS:
+            yield elem
+        else:
+            stack.append(iter(elem))
+
+
+def element_to_dict(elem):
+    """Converts a content element to its section dictionary, None if empty."""
+    if elem.tag in HEADINGS:
+        return {
+            "type": elem.tag,
+            "content": normalize_text(elem.text_content()),
+            "children": [],
+        }
+    if elem.tag in ["ul", "ol"]:
+        items = [normalize_text(li.text_content()) for li in elem.iterchildren("li")]
+        items = [item for item in items if item]
+        if not items:
+            return None
+        list_type = "ordered_list" if elem.tag == "ol" else "unordered_list"
+        return {"type": list_type, "content": items}
+    if elem.tag in ["pre", "code"]:
+        # Keep the original layout of the code
+        code_text = elem.text_content().strip("\n").rstrip()
+        if not code_text.strip():
+            return None
+        return {"type": "code", "content": code_to_markdown(code_text)}
+    text = normalize_text(elem.text_content())
+    if not text:
+        return None
+    return {"type": elem.tag, "content": text}
+
+
+def normalize_text(text):
+    """Collapses the whitespace of a text."""
+    return " ".join(text.split())
+
+
+def extract_links_from_tree(root, base_url):
+    """Extracts the absolute URLs linked from a page parsed by lxml."""
+    if root is None:
+        return []
+    links = []
+    for href in root.xpath("//a/@href"):
+        link, _ = urldefrag(urljoin(base_url, href.strip()))
+        if link.startswith(("http://", "https://")):
+            links.append(link)
+    return links
+
+
+def extract_content_from_soup(soup):
+    """
+    Extracts the sections of an already parsed page.
+
+    Sections are yielded as soon as they are complete, that is, when the
+    next heading is found.
+    """
     # Remove scripts, styles, and non-visible elements
-    for tag in soup(
-        ["script", "style", "noscript", "header", "footer", "nav", "aside"]
-    ):
+    for tag in soup(REMOVED_TAGS):
         tag.decompose()
 
     # Group elements under their closest heading
-    sections = []
     current_section = None
-    for elem in soup.find_all(
-        ["h1", "h2", "h3", "h4", "h5", "h6", "p", "ul", "ol", "pre", "code"]
-    ):
-        if elem.name in ["h1", "h2", "h3", "h4", "h5", "h6"]:
-            # New heading, create new section
-            section = {
+    for elem in soup.find_all(CONTENT_TAGS):
+        if elem.name in HEADINGS:
+            # New heading, the previous section is complete
+            if current_section is not None:
+                yield current_section
+            current_section = {
                 "type": elem.name,
                 "content": elem.get_text(strip=True),
                 "children": [],
             }
-            sections.append(section)
-            current_section = section
         else:
             # Create the element dictionary
             child = {}
@@ -57,9 +188,20 @@ def extract_content_from_url(url):
                 current_section["children"].append(child)
             else:
                 # If there is no previous heading, add as root section
-                sections.append(child)
+                yield child
+
+    if current_section is not None:
+        yield current_section
 
-    return sections
+
+def extract_links_from_soup(soup, base_url):
+    """Extracts the absolute URLs linked from an already parsed page."""
+    links = []
+    for anchor in soup.find_all("a", href=True):
+        link, _ = urldefrag(urljoin(base_url, anchor["href"]))
+        if link.startswith(("http://", "https://")):
+            links.append(link)
+    return links
 
 
 def code_to_markdown(code_text):
@@ -67,58 +209,176 @@ def code_to_markdown(code_text):
     return f"```\n{code_text}\n```"
 
 
-def section_to_markdown(section, level=1):
-    """Converts a hierarchical section to markdown text, recursively."""
-    md = ""
-    if section['type'] in [f'h{i}' for i in range(1, 7)]:
+def block_to_markdown(section):
+    """Converts a section, without its children, to markdown text."""
+    if section['type'] in HEADINGS:
         hashes = '#' * int(section['type'][1])
-        md += f"{hashes} {section['content']}\n\n"
-    elif section['type'] == 'code':
-        md += f"{section['content']}\n\n"
-    elif section['type'] == 'ordered_list':
-        for idx, item in enumerate(section['content'], 1):
-            md += f"{idx}. {item}\n"
-        md += "\n"
-    elif section['type'] == 'unordered_list':
-        for item in section['content']:
-            md += f"- {item}\n"
-        md += "\n"
-    elif section['type'] == 'p':
-        md += f"{section['content']}\n\n"
-    else:
-        md += f"{section['content']}\n\n"
-    # Process children if they exist
-    if 'children' in section and section['children']:
-        for child in section['children']:
-            md += section_to_markdown(child, level + 1)
-    return md
+        return f"{hashes} {section['content']}"
+    if section['type'] == 'ordered_list':
+        return "\n".join(
+            f"{idx}. {item}" for idx, item in enumerate(section['content'], 1)
+        )
+    if section['type'] == 'unordered_list':
+        return "\n".join(f"- {item}" for item in section['content'])
+    return section['content']
+
+
+def count_tokens(text):
+    """Estimates the number of tokens of a text, counting words and symbols."""
+    return len(TOKEN_PATTERN.findall(text))
+
+
+def split_text(text, max_tokens):
+    """Splits a text in pieces of at most max_tokens tokens."""
+    starts = [match.start() for match in TOKEN_PATTERN.finditer(text)]
+    cuts = starts[max_tokens::max_tokens]
+    for start, end in zip([0] + cuts, cuts + [len(text)]):
+        piece = text[start:end].strip()
+        if piece:
+            yield piece, count_tokens(piece)
+
+
+def split_length(text, max_length):
+    """Splits a text in pieces of at most max_length characters, between words."""
+    while len(text) > max_length:
+        cut = text.rfind(" ", 0, max_length)
+        if cut <= 0:
+            cut = max_length
+        yield text[:cut].rstrip()
+        text = text[cut:].lstrip()
+    if text:
+        yield text
+
+
+def split_code(code, max_tokens, max_length):
+    """
+    Splits a markdown code block at line boundaries, in code blocks of at most
+    max_tokens tokens and max_length characters.
+    """
+    fence = code_to_markdown("")
+    max_tokens -= count_tokens(fence)
+    max_length -= len(fence)
+    lines = []
+    for line in code[len("```\n") : -len("\n```")].split("\n"):
+        if count_tokens(line) <= max_tokens and len(line) <= max_length:
+            lines.append(line)
+            continue
+        # Only the lines longer than a chunk lose their indentation
+        for piece, _ in split_text(line, max_tokens):
+            lines.extend(split_length(piece, max_length))
+    piece, size, length = [], 0, 0
+    for line in lines:
+        tokens = count_tokens(line)
+        if piece and (
+            size + tokens > max_tokens or length + len(line) + 1 > max_length
+        ):
+            yield code_to_markdown("\n".join(piece))
+            piece, size, length = [], 0, 0
+        piece.append(line)
+        size += tokens
+        length += len(line) + 1
+    if piece:
+        yield code_to_markdown("\n".join(piece))
 
 
-def flatten_markdown_chunks(sections, max_length=1024):
+def split_block(text, is_code, max_tokens, max_length):
     """
-    Converts the hierarchical structure to flat chunks
-    with order and content in markdown.
+    Splits a block in pieces of at most max_tokens tokens and max_length
+    characters, counting the separator between blocks. Code blocks are split
+    at line boundaries, each piece in its own code block.
     """
-    all_md = ""
+    tokens = count_tokens(text) + 1
+    if tokens <= max_tokens and len(text) + 2 <= max_length:
+        return [(text, tokens)]
+    if is_code:
+        pieces = split_code(text, max_tokens - 1, max_length - 2)
+    else:
+        pieces = (
+            part
+            for piece, _ in split_text(text, max_tokens - 1)
+            for part in split_length(piece, max_length - 2)
+        )
+    return [(piece, count_tokens(piece) + 1) for piece in pieces]
+
+
+def iter_blocks(sections):
+    """Yields the markdown blocks of the sections, with their heading path."""
+    path = []
     for section in sections:
-        all_md += section_to_markdown(section)
-    # Split into chunks of maximum max_length
-    chunks = []
-    current = ""
-    for part in all_md.split('\n\n'):
-        if not part.strip():
+        if section['type'] in HEADINGS:
+            level = int(section['type'][1])
+            while path and path[-1][0] >= level:
+                path.pop()
+            path.append((level, section['content']))
+        headings = [heading for _, heading in path]
+        for block in [section] + (section.get('children') or []):
+            yield headings, block_to_markdown(block), block['type'] == 'code'
+
+
+def iter_token_chunks(
+    sections,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    chunk_overlap=DEFAULT_CHUNK_OVERLAP,
+    max_length=EMBEDDINGS_MAX_LENGTH,
+):
+    """
+    Converts the hierarchical structure to flat chunks in markdown of at most
+    chunk_size tokens and max_length characters, the longest text embedded,
+    yielding each chunk as soon as it is complete.
+
+    Chunks are packed with whole blocks (headings, paragraphs, lists, code),
+    and each chunk starts with the last blocks of the previous one, up to
+    chunk_overlap tokens. Blocks larger than a chunk are split, code blocks
+    at line boundaries. Each chunk carries the heading path of its first new
+    block.
+    """
+    order = 0
+    # Blocks of the current chunk, as (headings, text, tokens)
+    current = []
+    n_overlap = 0
+    size = 0
+    length = 0
+    for headings, text, is_code in iter_blocks(sections):
+        if not text.strip():
             continue
-        if len(current) + len(part) + 2 > max_length:
-            if current:
-                chunks.append(current.strip())
-            current = part + '\n\n'
-        else:
-            current += part + '\n\n'
-    if current.strip():
-        chunks.append(current.strip())
-    # Create a list of dictionaries with order, content, and length
-    markdown_chunks = [
-        {"order": i + 1, "content": chunk, "length": len(chunk)}
-        for i, chunk in enumerate(chunks)
-    ]
-    return markdown_chunks
+        for piece, tokens in split_block(text, is_code, chunk_size, max_length):
+            if len(current) > n_overlap and (
+                size + tokens > chunk_size or length + len(piece) + 2 > max_length
+            ):
+                order += 1
+                yield token_chunk(order, current, n_overlap)
+                current = overlap_blocks(current, chunk_overlap)
+                n_overlap = len(current)
+                size = sum(block[2] for block in current)
+                length = sum(len(block[1]) + 2 for block in current)
+            if size + tokens > chunk_size or length + len(piece) + 2 > max_length:
+                # The overlap does not leave room for the block
+                current, n_overlap, size, length = [], 0, 0, 0
+            current.append((headings, piece, tokens))
+            size += tokens
+            length += len(piece) + 2
+    if len(current) > n_overlap:
+        order += 1
+        yield token_chunk(order, current, n_overlap)
+
+
+def overlap_blocks(blocks, chunk_overlap):
+    """Gets the last blocks of a chunk that fit in chunk_overlap tokens."""
+    overlap = []
+    size = 0
+    for block in reversed(blocks):
+        size += block[2]
+        if size > chunk_overlap:
+            break
+        overlap.append(block)
+    return overlap[::-1]
+
+
+def token_chunk(order, blocks, n_overlap):
+    """Creates a dictionary with the order, content, tokens and headings of a chunk."""
+    return {
+        "order": order,
+        "content": "\n\n".join(block[1] for block in blocks),
+        "tokens": sum(block[2] for block in blocks),
+        "headings": blocks[n_overlap][0],
+    }
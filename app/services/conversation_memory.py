@@ -0,0 +1,167 @@
+import datetime
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+import redis
+from config.config import settings
+from services.bedrock_llm import aquery_model
+from services.chunking import count_tokens
+from services.metrics import increment
+
+MEMORY_TOKEN_BUDGET = settings.memory_token_budget
+MEMORY_SUMMARY_TOKENS = settings.memory_summary_tokens
+CACHE_BACKEND = settings.memory_cache_backend
+CACHE_URL = settings.memory_cache_url
+TTL = settings.memory_cache_ttl
+KEY_PREFIX = "memory:"
+# Tokens of the summary of the earlier turns
+SUMMARY_TOKENS = 300
+
+
+class SummaryCache:
+    """
+    Rolling summaries of the chats, stored in Redis.
+
+    Each chat keeps its summary in a hash, with the creation time and ID of
+    the newest message it covers. The key expires after the TTL without
+    new summaries.
+    """
+
+    def __init__(self, url: str, ttl: int):
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, chat_id: str) -> Optional[Dict]:
+        entry = self.client.hgetall(KEY_PREFIX + chat_id)
+        if not entry:
+            return None
+        return {key.decode(): value.decode() for key, value in entry.items()}
+
+    def set(self, chat_id: str, summary: str, created_at: str, id: str):
+        pipeline = self.client.pipeline()
+        pipeline.hset(
+            KEY_PREFIX + chat_id,
+            mapping={"summary": summary, "created_at": created_at, "id": id},
+        )
+        pipeline.expire(KEY_PREFIX + chat_id, self.ttl)
+        pipeline.execute()
+
+
+def create_cache():
+    """Create the summary cache for the configured backend."""
+    if CACHE_BACKEND == "redis":
+        return SummaryCache(CACHE_URL, TTL)
+    return None
+
+
+cache = create_cache()
+
+
+def get_summary(chat_id: str) -> Tuple[Optional[str], Optional[Tuple], bool]:
+    """
+    Get the summary of the earlier turns of a chat, if it is cached.
+
+    Returns:
+        the summary, the creation time and ID of the newest message it
+        covers, to load the messages after it, and whether the cache is
+        available to save a new summary
+    """
+    if cache is None:
+        return None, None, False
+    try:
+        entry = cache.get(str(chat_id))
+    except redis.RedisError as e:
+        print(f"Summary cache unavailable: {e}")
+        return None, None, False
+    if entry is None:
+        return None, None, True
+    created_at = datetime.datetime.fromisoformat(entry["created_at"])
+    return entry["summary"], (created_at, uuid.UUID(entry["id"])), True
+
+
+def save_summary(chat_id: str, summary: str, last_message: Dict):
+    """Cache the summary of a chat, up to its last summarized message."""
+    if cache is None:
+        return
+    try:
+        cache.set(
+            str(chat_id),
+            summary,
+            last_message["created_at"].isoformat(),
+            str(last_message["id"]),
+        )
+    except redis.RedisError as e:
+        print(f"Summary cache unavailable: {e}")
+
+
+def split_window(messages: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Split the messages of a chat, newest first, in the older messages and
+    the window of recent turns that fits in the memory token budget.
+
+    The window starts with a question of the user. Both lists are returned
+    oldest first.
+    """
+    size = 0
+    start = len(messages)
+    for i, message in enumerate(messages):
+        size += count_tokens(message["content"])
+        if size > MEMORY_TOKEN_BUDGET:
+            start = i
+            break
+    window = messages[:start]
+    while window and window[-1]["role"] != "user":
+        window.pop()
+    return messages[len(window) :][::-1], window[::-1]
+
+
+def needs_summary(older: List[Dict], complete: bool) -> bool:
+    """
+    Check whether the older messages must be added to the summary.
+
+    They are summarized in batches, and kept in the prompts meanwhile, so the
+    summary is only updated once every few turns. When the loaded messages
+    are not all the messages after the summary, they are always summarized.
+    """
+    if not older:
+        return False
+    tokens = sum(count_tokens(message["content"]) for message in older)
+    return tokens >= MEMORY_SUMMARY_TOKENS or not complete
+
+
+async def summarize(summary: Optional[str], messages: List[Dict]) -> str:
+    """Add the older messages of a chat to the summary of its earlier turns."""
+    conversation = "\n".join(
+        f"{message['role']}: {message['content']}" for message in messages
+    )
+    prompt = (
+        "You are maintaining the memory of a conversation between a user and an "
+        "assistant answering questions about the documentation of a library, "
+        "framework or API. "
+        "Update the summary of the conversation with the new messages. "
+        "Keep the topics, the names of the functions, parameters and versions "
+        "mentioned, the facts established and the open questions. "
+        "Return only the summary, in a few sentences.\n\n"
+        f"Summary: {summary or 'The conversation has just started.'}\n\n"
+        f"New messages:\n{conversation}\n\n"
+        "Updated summary:"
+    )
+    increment("memory_summaries")
+    return (
+        await aquery_model(
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.0,
+            tokens=SUMMARY_TOKENS,
+        )
+    ).strip()
+
+
+def memory_messages(summary: Optional[str], messages: List[Dict]) -> List[Dict]:
+    """Get the messages of the memory of a chat, to prepend to the prompts."""
+    history = [
+        {"role": message["role"], "content": message["content"]} for message in messages
+    ]
+    if summary:
+        content = f"Summary of the earlier conversation with the user: {summary}"
+        history.insert(0, {"role": "system", "content": content})
+    return history
@@ -0,0 +1,154 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+from urllib.parse import urldefrag, urlparse
+from xml.etree import ElementTree
+
+import requests
+from config.config import settings
+from requests.adapters import HTTPAdapter
+from services.chunking import extract_content_from_html, extract_links_from_html
+
+MAX_PAGES = settings.crawl_max_pages
+MAX_DEPTH = settings.crawl_max_depth
+CONCURRENCY = settings.crawl_concurrency
+CONNECTIONS_PER_HOST = settings.crawl_connections_per_host
+TIMEOUT = 30
+MAX_SITEMAPS = 20
+SKIPPED_EXTENSIONS = tuple(
+    ".png .jpg .jpeg .gif .svg .ico .webp .pdf .zip .gz .tar .css .js .xml".split()
+)
+
+# Shared session, so connections to the same host are kept alive and reused
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=CONCURRENCY, pool_maxsize=CONNECTIONS_PER_HOST)
+session.mount("http://", adapter)
+session.mount("https://", adapter)
+
+_host_limits = {}
+_host_limits_lock = threading.Lock()
+
+
+def host_limit(url: str) -> threading.Semaphore:
+    """Get the semaphore limiting the open connections to the host of a URL."""
+    host = urlparse(url).netloc
+    with _host_limits_lock:
+        if host not in _host_limits:
+            _host_limits[host] = threading.Semaphore(CONNECTIONS_PER_HOST)
+        return _host_limits[host]
+
+
+def fetch(url: str) -> requests.Response:
+    """Fetch a URL, respecting the per-host connection limit."""
+    with host_limit(url):
+        response = session.get(url, timeout=TIMEOUT)
+    response.raise_for_status()
+    return response
+
+
+def fetch_sections(url: str):
+    """Fetch a page and extract its sections."""
+    response = fetch(url)
+    return extract_content_from_html(response.text)
+
+
+def fetch_links(url: str) -> List[str]:
+    """Fetch a page and extract the links it contains."""
+    try:
+        response = fetch(url)
+    except requests.RequestException as e:
+        print(f"Could not fetch {url}: {e}")
+        return []
+    if "html" not in response.headers.get("Content-Type", "text/html"):
+        return []
+    return extract_links_from_html(response.text, response.url)
+
+
+def url_prefix(url: str) -> str:
+    """Get the prefix that every page of the documentation must share."""
+    url, _ = urldefrag(url)
+    if url.endswith("/"):
+        return url
+    parsed = urlparse(url)
+    if not parsed.path:
+        return url + "/"
+    return url.rsplit("/", 1)[0] + "/"
+
+
+def is_crawlable(url: str, prefix: str) -> bool:
+    """Check whether a URL belongs to the documentation being crawled."""
+    path = urlparse(url).path.lower()
+    return url.startswith(prefix) and not path.endswith(SKIPPED_EXTENSIONS)
+
+
+def fetch_sitemap_urls(url: str) -> List[str]:
+    """Get the page URLs listed in the sitemap of a site."""
+    parsed = urlparse(url)
+    pending = [f"{parsed.scheme}://{parsed.netloc}/sitemap.xml"]
+    prefix_sitemap = url_prefix(url) + "sitemap.xml"
+    if prefix_sitemap not in pending:
+        pending.append(prefix_sitemap)
+    visited = set()
+    urls = []
+    while pending and len(visited) < MAX_SITEMAPS:
+        sitemap_url = pending.pop(0)
+        if sitemap_url in visited:
+            continue
+        visited.add(sitemap_url)
+        try:
+            root = ElementTree.fromstring(fetch(sitemap_url).content)
+        except (requests.RequestException, ElementTree.ParseError):
+            continue
+        for elem in root.iter():
+            if not elem.tag.endswith("loc") or not elem.text:
+                continue
+            loc = elem.text.strip()
+            # Sitemap indexes point to other sitemaps
+            if root.tag.endswith("sitemapindex"):
+                pending.append(loc)
+            else:
+                urls.append(loc)
+    return urls
+
+
+def discover_pages(
+    url: str,
+    max_pages: Optional[int] = MAX_PAGES,
+    max_depth: Optional[int] = MAX_DEPTH,
+) -> List[str]:
+    """
+    Discover the pages of a documentation site.
+
+    Pages are taken from the sitemap and from the links found in the pages,
+    following links up to max_depth levels, and only keeping the pages
+    that share the prefix of the initial URL.
+    """
+    max_pages = max_pages or MAX_PAGES
+    max_depth = MAX_DEPTH if max_depth is None else max_depth
+    url, _ = urldefrag(url)
+    prefix = url_prefix(url)
+    pages = [url]
+    seen = {url}
+
+    def add(link: str) -> bool:
+        link, _ = urldefrag(link)
+        if len(pages) >= max_pages or link in seen or not is_crawlable(link, prefix):
+            return False
+        seen.add(link)
+        pages.append(link)
+        return True
+
+    for link in fetch_sitemap_urls(url):
+        add(link)
+    print(f"Found {len(pages)} pages in sitemap")
+
+    frontier = [url]
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+        for _ in range(max_depth):
+            if not frontier or len(pages) >= max_pages:
+                break
+            next_frontier = []
+            for links in executor.map(fetch_links, frontier):
+                next_frontier.extend(link for link in links if add(link))
+            frontier = next_frontier
+    return pages
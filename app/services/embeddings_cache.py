@@ -0,0 +1,182 @@
+import hashlib
+import sqlite3
+import time
+from array import array
+from contextlib import contextmanager
+from typing import Callable, ContextManager, Dict, List, Optional
+
+import redis
+from config.config import settings
+from services.metrics import increment
+
+CACHE_BACKEND = settings.embeddings_cache_backend
+CACHE_URL = settings.embeddings_cache_url
+CACHE_PATH = settings.embeddings_cache_path
+CACHE_MAX_ENTRIES = settings.embeddings_cache_max_entries
+EMBEDDINGS_MODEL = settings.aws_embeddings_model
+KEY_PREFIX = "embedding:"
+LRU_KEY = "embedding-lru"
+
+
+def encode(vector: List[float]) -> bytes:
+    """Encode a vector as packed float32 values."""
+    return array("f", vector).tobytes()
+
+
+def decode(data: bytes) -> List[float]:
+    """Decode a vector packed as float32 values."""
+    vector = array("f")
+    vector.frombytes(data)
+    return vector.tolist()
+
+
+class RedisCache:
+    """Embeddings cache stored in Redis, evicting the least recently used."""
+
+    def __init__(self, url: str, max_entries: int):
+        self.client = redis.Redis.from_url(url)
+        self.max_entries = max_entries
+
+    def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        values = self.client.mget([KEY_PREFIX + key for key in keys])
+        hits = {key: time.time() for key, value in zip(keys, values) if value}
+        if hits:
+            self.client.zadd(LRU_KEY, hits)
+        return values
+
+    def set_many(self, items: Dict[str, bytes]):
+        now = time.time()
+        pipeline = self.client.pipeline()
+        pipeline.mset({KEY_PREFIX + key: value for key, value in items.items()})
+        pipeline.zadd(LRU_KEY, {key: now for key in items})
+        pipeline.zcard(LRU_KEY)
+        size = pipeline.execute()[-1]
+        if size > self.max_entries:
+            evicted = self.client.zpopmin(LRU_KEY, size - self.max_entries)
+            self.client.delete(*[KEY_PREFIX + key.decode() for key, _ in evicted])
+
+
+@contextmanager
+def closing_connection(connection: sqlite3.Connection):
+    """Commit the changes of a SQLite connection and close it."""
+    try:
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+class DiskCache:
+    """Embeddings cache stored in SQLite, evicting the least recently used."""
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        with self.connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(key TEXT PRIMARY KEY, vector BLOB NOT NULL, accessed REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_accessed "
+                "ON embeddings (accessed)"
+            )
+
+    def connect(self) -> ContextManager[sqlite3.Connection]:
+        # A connection per operation, so it is never shared across the threads
+        # or the forked processes of the workers
+        return closing_connection(sqlite3.connect(self.path, timeout=30))
+
+    def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        values = {}
+        with self.connect() as connection:
+            # Stay under the SQLite limit of variables per query
+            for i in range(0, len(keys), 500):
+                batch = keys[i : i + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = connection.execute(
+                    "SELECT key, vector FROM embeddings "
+                    f"WHERE key IN ({placeholders})",
+                    batch,
+                ).fetchall()
+                values.update(rows)
+            connection.executemany(
+                "UPDATE embeddings SET accessed = ? WHERE key = ?",
+                [(time.time(), key) for key in values],
+            )
+        return [values.get(key) for key in keys]
+
+    def set_many(self, items: Dict[str, bytes]):
+        now = time.time()
+        with self.connect() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                [(key, value, now) for key, value in items.items()],
+            )
+            connection.execute(
+                "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings "
+                "ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+
+def create_cache():
+    """Create the embeddings cache for the configured backend."""
+    if CACHE_BACKEND == "redis":
+        return RedisCache(CACHE_URL, CACHE_MAX_ENTRIES)
+    if CACHE_BACKEND == "disk":
+        return DiskCache(CACHE_PATH, CACHE_MAX_ENTRIES)
+    return None
+
+
+cache = create_cache()
+
+
+def cache_key(text: str, input_type: str) -> str:
+    """Get the cache key of a text for the embeddings model and input type."""
+    content = f"{EMBEDDINGS_MODEL}|{input_type}|{text}"
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def cached_embeddings(
+    texts: List[str],
+    input_type: str,
+    embed: Callable[[List[str]], List[List[float]]],
+) -> List[List[float]]:
+    """
+    Get the embeddings of a list of texts, only embedding the cache misses.
+
+    Args:
+        texts: texts to embed
+        input_type: input type of the embeddings model
+        embed: function embedding the texts missing from the cache
+
+    Returns:
+        embeddings, in the same order as the texts
+    """
+    if cache is None:
+        return embed(texts)
+    keys = [cache_key(text, input_type) for text in texts]
+    try:
+        cached = cache.get_many(keys)
+    except (redis.RedisError, sqlite3.Error) as e:
+        print(f"Embeddings cache unavailable: {e}")
+        return embed(texts)
+    vectors = {key: decode(value) for key, value in zip(keys, cached) if value}
+    # Texts repeated in the input are only embedded once
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in vectors:
+            missing.setdefault(key, text)
+    if missing:
+        embeddings = embed(list(missing.values()))
+        new_vectors = dict(zip(missing.keys(), embeddings))
+        vectors.update(new_vectors)
+        try:
+            cache.set_many({key: encode(v) for key, v in new_vectors.items()})
+        except (redis.RedisError, sqlite3.Error) as e:
+            print(f"Embeddings cache unavailable: {e}")
+    # Counted in the process metrics, see the metrics endpoint
+    increment("embeddings_cache_hits", len(texts) - len(missing))
+    increment("embeddings_cache_misses", len(missing))
+    return [vectors[key] for key in keys]
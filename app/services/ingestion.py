@@ -0,0 +1,141 @@
+import hashlib
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterable, Iterator, List
+
+from config.config import settings
+from services.bedrock_embeddings import BATCH_SIZE, embed_texts
+from services.chunking import iter_token_chunks
+from services.qdrant import delete_points, filter_by_url, scroll_ids, store_points
+from services.sparse_vectors import document_sparse_vector
+
+EMBED_WORKERS = settings.ingestion_embed_workers
+STORE_WORKERS = settings.ingestion_store_workers
+QUEUE_SIZE = settings.ingestion_queue_size
+
+
+class BoundedExecutor:
+    """Thread pool whose submit blocks while its queue of pending tasks is full."""
+
+    def __init__(self, workers: int, queue_size: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def submit(self, fn, *args) -> Future:
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.executor.shutdown(wait=True)
+
+
+def chunk_id(corpus_id: str, url: str, content_hash: str) -> str:
+    """Get the deterministic point id of a chunk of a page in a corpus."""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{corpus_id}|{url}|{content_hash}"))
+
+
+def iter_batches(items: Iterable, size: int) -> Iterator[List]:
+    """Group the items of an iterable in lists of the given size."""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def index_sections(sections: Iterable[dict], url: str, corpus_id: str) -> int:
+    """
+    Chunk, embed and store the sections of a page, as a streaming pipeline.
+
+    Chunks flow through the pipeline in batches: while the sections are being
+    chunked, the previous batches are embedded and the embedded ones are
+    stored. The stages are bounded, so a slow stage blocks the previous ones
+    and only a few batches are held in memory whatever the size of the page.
+
+    Point ids are derived from the chunk content, so re-indexing a page only
+    embeds and stores the new or changed chunks, and deletes the stale ones.
+    """
+    stored_ids = set(scroll_ids(filter_by_url(corpus_id, url)))
+    seen_ids = set()
+
+    def new_chunks() -> Iterator[dict]:
+        for chunk in iter_token_chunks(sections):
+            content = "\n".join(chunk["headings"] + [chunk["content"]])
+            content_hash = hashlib.sha256(content.encode()).hexdigest()
+            id = chunk_id(corpus_id, url, content_hash)
+            if id in seen_ids:
+                continue
+            seen_ids.add(id)
+            if id in stored_ids:
+                continue
+            yield {
+                "id": id,
+                "text": chunk["content"],
+                "url": url,
+                "corpus_id": corpus_id,
+                "headings": chunk["headings"],
+                "order": chunk["order"],
+                "content_hash": content_hash,
+            }
+
+    def store(batch: List[dict], vectors: List[List[float]], wait: bool = False):
+        ids = [payload.pop("id") for payload in batch]
+        # Headings are included, identifiers are often in them
+        sparse_vectors = [
+            document_sparse_vector("\n".join(p["headings"] + [p["text"]]))
+            for p in batch
+        ]
+        store_points(ids, batch, vectors, wait=wait, sparse_vectors=sparse_vectors)
+
+    futures = []
+    n_documents = 0
+    last_batch = None
+    with BoundedExecutor(STORE_WORKERS, QUEUE_SIZE) as storers:
+
+        def embed(batch: List[dict]) -> Future:
+            vectors = embed_texts([payload["text"] for payload in batch])
+            # Blocks this embedding worker while the store queue is full
+            return storers.submit(store, batch, vectors)
+
+        with BoundedExecutor(EMBED_WORKERS, QUEUE_SIZE) as embedders:
+            for batch in iter_batches(new_chunks(), BATCH_SIZE):
+                n_documents += len(batch)
+                # The last batch is held back, see below
+                if last_batch is not None:
+                    futures.append(embedders.submit(embed, last_batch))
+                last_batch = batch
+                # Fail fast instead of feeding a broken pipeline
+                for future in futures:
+                    if future.done() and future.exception():
+                        raise future.exception()
+        store_futures = [future.result() for future in futures]
+    for future in store_futures:
+        future.result()
+    if last_batch is not None:
+        # Stored once the others are acknowledged, waiting for it to be
+        # applied: updates are applied in order, so the whole page is
+        # searchable when the task reports success
+        vectors = embed_texts([payload["text"] for payload in last_batch])
+        store(last_batch, vectors, wait=True)
+
+    stale_ids = [id for id in stored_ids if id not in seen_ids]
+    print(
+        f"{url}: {n_documents} new, {len(stale_ids)} stale, "
+        f"{len(seen_ids) - n_documents} unchanged chunks"
+    )
+    # Stale chunks are deleted once their replacements are stored
+    delete_points(stale_ids)
+    return n_documents
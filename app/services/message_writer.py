@@ -0,0 +1,197 @@
+import asyncio
+import datetime
+import uuid
+from typing import Dict, List, Optional
+
+from config.config import settings
+from db.pg_connection import SessionLocal
+from models.chat import Message
+from services.blocking import run_blocking
+from services.metrics import increment
+from sqlalchemy.exc import DataError, IntegrityError
+
+MESSAGE_DURABILITY = settings.message_durability
+QUEUE_SIZE = settings.message_queue_size
+BATCH_SIZE = settings.message_batch_size
+FLUSH_INTERVAL = settings.message_flush_interval
+# Attempts to write a batch before writing its exchanges one by one
+WRITE_ATTEMPTS = 3
+
+
+def utcnow() -> datetime.datetime:
+    """Get the current UTC time, as stored by the database."""
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def exchange_messages(
+    chat_id: str, message: str, answer: str, asked_at: datetime.datetime
+) -> List[Dict]:
+    """
+    Build the messages of a question of the user and its answer.
+
+    Their IDs and creation times are set here, not by the database, so they
+    keep their order when written in the same transaction, or later.
+    """
+    return [
+        {
+            "id": uuid.uuid4(),
+            "chat_id": chat_id,
+            "role": "user",
+            "content": message,
+            "created_at": asked_at,
+        },
+        {
+            "id": uuid.uuid4(),
+            "chat_id": chat_id,
+            "role": "assistant",
+            "content": answer,
+            "created_at": max(utcnow(), asked_at),
+        },
+    ]
+
+
+def write_messages(messages: List[Dict]):
+    """Write messages in a single transaction."""
+    with SessionLocal() as db:
+        db.add_all([Message(**message) for message in messages])
+        db.commit()
+
+
+class MessageWriter:
+    """
+    Write-behind queue of the messages of the chats.
+
+    The exchanges are queued, so the commits are not in the response path,
+    and written in batches across requests, each batch in one transaction.
+    If a batch cannot be written, its exchanges are written one by one and
+    only the ones failing are dropped. The queue is bounded: when it is full,
+    saving an exchange waits for a free slot, or writes it in its own
+    transaction if the writer stops meanwhile. The queued exchanges are
+    written when the writer is stopped, but they are lost if the process
+    crashes before.
+    """
+
+    def __init__(self, queue_size: int, batch_size: int, flush_interval: float):
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+        # Queued or in-flight messages of each chat, until they are written
+        self.pending: Dict[str, List[Dict]] = {}
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def start(self):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        task, self.task = self.task, None
+        if task is None or task.done():
+            return
+        # Written after the exchanges queued before it
+        await self.queue.put(None)
+        await task
+
+    async def put(self, messages: List[Dict]) -> bool:
+        """
+        Queue an exchange, waiting for a free slot while the queue is full.
+
+        Returns False, without queueing it, if the writer is not running.
+        """
+        while self.running:
+            try:
+                self.queue.put_nowait(messages)
+            except asyncio.QueueFull:
+                # Checks again that the writer runs, it may have stopped
+                await asyncio.sleep(self.flush_interval)
+                continue
+            # Only once queued, a cancelled put must not leave them pending
+            chat_id = str(messages[0]["chat_id"])
+            self.pending.setdefault(chat_id, []).extend(messages)
+            return True
+        return False
+
+    def get_pending(self, chat_id: str) -> List[Dict]:
+        return list(self.pending.get(str(chat_id), []))
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        stopped = False
+        while not stopped:
+            exchange = await self.queue.get()
+            if exchange is None:
+                break
+            batch = [exchange]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    exchange = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if exchange is None:
+                    stopped = True
+                    break
+                batch.append(exchange)
+            await self.flush(batch)
+
+    async def flush(self, batch: List[List[Dict]]):
+        messages = [message for exchange in batch for message in exchange]
+        if not await self.write(messages, WRITE_ATTEMPTS):
+            # Each exchange in its own transaction, so an exchange that cannot
+            # be written does not lose the rest of the batch
+            for exchange in batch:
+                if len(batch) == 1 or not await self.write(exchange, 1):
+                    increment("messages_dropped", len(exchange))
+        for message in messages:
+            chat_id = str(message["chat_id"])
+            self.pending[chat_id].remove(message)
+            if not self.pending[chat_id]:
+                del self.pending[chat_id]
+
+    async def write(self, messages: List[Dict], attempts: int) -> bool:
+        for attempt in range(attempts):
+            try:
+                await run_blocking(write_messages, messages)
+                increment("messages_written", len(messages))
+                return True
+            except (DataError, IntegrityError) as e:
+                # Fails again if retried
+                print(f"Error writing {len(messages)} messages: {e}")
+                return False
+            except Exception as e:
+                print(f"Error writing {len(messages)} messages: {e}")
+                if attempt < attempts - 1:
+                    await asyncio.sleep(2**attempt)
+        return False
+
+
+message_writer = MessageWriter(QUEUE_SIZE, BATCH_SIZE, FLUSH_INTERVAL)
+
+
+async def save_exchange(
+    chat_id: str, message: str, answer: str, asked_at: datetime.datetime
+):
+    """
+    Save a question of the user and its answer, with the configured durability.
+
+    With 'write-behind' they are queued and written in the background, with
+    'transaction', or when the writer is not running or has stopped on an
+    error, they are written in a single transaction before returning. The
+    chat must exist, which the callers check before saving.
+    """
+    messages = exchange_messages(chat_id, message, answer, asked_at)
+    if MESSAGE_DURABILITY == "write-behind" and await message_writer.put(messages):
+        return
+    await run_blocking(write_messages, messages)
+
+
+def pending_messages(chat_id: str) -> List[Dict]:
+    """Get the messages of a chat saved but not yet written, oldest first."""
+    return message_writer.get_pending(chat_id)
@@ -0,0 +1,18 @@
+import threading
+from collections import Counter
+
+# Counters of the process, see the metrics endpoint
+counters = Counter()
+counters_lock = threading.Lock()
+
+
+def increment(name: str, value: int = 1):
+    """Increment a counter of the process metrics."""
+    with counters_lock:
+        counters[name] += value
+
+
+def snapshot() -> dict:
+    """Get the current value of every counter of the process metrics."""
+    with counters_lock:
+        return dict(counters)
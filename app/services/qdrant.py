@@ -1,6 +1,8 @@
-from typing import Optional
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
 
-from qdrant_client import QdrantClient, models
+from qdrant_client import AsyncQdrantClient, QdrantClient, models
 
 from app.config.config import settings
 
@@ -9,37 +11,180 @@ client = QdrantClient(
     URL_QDRANT,
     port=6333,
     grpc_port=6334,
+    prefer_grpc=settings.qdrant_prefer_grpc,
+    timeout=30,
+)
+# Used by the async endpoints
+async_client = AsyncQdrantClient(
+    URL_QDRANT,
+    port=6333,
+    grpc_port=6334,
+    prefer_grpc=settings.qdrant_prefer_grpc,
     timeout=30,
 )
 COLLECTION_NAME = settings.collection_name
 MAX_CHUNKS_RETRIEVED = settings.max_chunks_retrieved
+UPLOAD_WORKERS = settings.qdrant_upload_workers
+BATCH_SIZE = settings.qdrant_batch_size
+SCROLL_LIMIT = 1000
+# Named sparse vector stored next to the unnamed dense vector
+SPARSE_VECTOR_NAME = "bm25"
+# Seconds before checking again whether the collection has the sparse vector
+SPARSE_VECTORS_CHECK_INTERVAL = 60
+sparse_vectors_check = {"enabled": False, "time": float("-inf")}
+# Keyword payload indexes, the first one marks the tenant of each point
+PAYLOAD_INDEXES = ["corpus_id", "chat_id", "url"]
+
+
+def ensure_collection(vector_size: int):
+    """
+    Create the Qdrant collection and its payload indexes, if they do not exist.
+
+    Idempotent: on an existing collection, the HNSW settings are updated and
+    the missing payload indexes are created.
+    """
+    hnsw_config = models.HnswConfigDiff(
+        m=settings.qdrant_hnsw_m,
+        ef_construct=settings.qdrant_hnsw_ef_construct,
+        payload_m=settings.qdrant_hnsw_payload_m,
+    )
+    if not client.collection_exists(COLLECTION_NAME):
+        print(f"Creating collection {COLLECTION_NAME} with size {vector_size}")
+        client.create_collection(
+            collection_name=COLLECTION_NAME,
+            vectors_config=models.VectorParams(
+                size=vector_size, distance=models.Distance.COSINE
+            ),
+            sparse_vectors_config={
+                SPARSE_VECTOR_NAME: models.SparseVectorParams(
+                    modifier=models.Modifier.IDF
+                )
+            },
+            hnsw_config=hnsw_config,
+            on_disk_payload=settings.qdrant_on_disk_payload,
+        )
+    else:
+        client.update_collection(
+            collection_name=COLLECTION_NAME, hnsw_config=hnsw_config
+        )
+        if not sparse_vectors_enabled(refresh=True):
+            print(
+                f"Collection {COLLECTION_NAME} has no {SPARSE_VECTOR_NAME} sparse "
+                "vector, recreate it to enable the hybrid search"
+            )
+    payload_schema = client.get_collection(COLLECTION_NAME).payload_schema
+    for field in PAYLOAD_INDEXES:
+        if field in payload_schema:
+            continue
+        print(f"Creating payload index on {field}")
+        client.create_payload_index(
+            collection_name=COLLECTION_NAME,
+            field_name=field,
+            field_schema=models.KeywordIndexParams(
+                type=models.KeywordIndexType.KEYWORD,
+                is_tenant=field == PAYLOAD_INDEXES[0],
+            ),
+            wait=True,
+        )
+
+
+def sparse_vectors_enabled(refresh: bool = False) -> bool:
+    """
+    Check whether the collection stores the sparse vectors.
 
+    The answer is kept for SPARSE_VECTORS_CHECK_INTERVAL seconds, so a
+    collection recreated with them is used without restarting the workers.
+    """
+    now = time.monotonic()
+    if refresh or now - sparse_vectors_check["time"] > SPARSE_VECTORS_CHECK_INTERVAL:
+        params = client.get_collection(COLLECTION_NAME).config.params
+        sparse_vectors_check["enabled"] = SPARSE_VECTOR_NAME in (
+            params.sparse_vectors or {}
+        )
+        sparse_vectors_check["time"] = now
+    return sparse_vectors_check["enabled"]
 
-def store_points(ids, payloads, vectors):
-    """Store points in the Qdrant collection."""
-    length = len(ids)
-    BATCH_SIZE = 2000
-    start = 0
-    while start < length:
-        end = min(start + BATCH_SIZE, length)
-        batch_ids = ids[start:end]
-        batch_payloads = payloads[start:end]
-        batch_vectors = vectors[start:end]
-        store_batch_of_points(batch_ids, batch_payloads, batch_vectors)
-        start += BATCH_SIZE
 
+def store_points(ids, payloads, vectors, wait: bool = True, sparse_vectors=None):
+    """
+    Store points in the Qdrant collection.
 
-def store_batch_of_points(ids, payloads, vectors):
+    The sparse vectors, if given, are only stored when the collection has
+    them.
+
+    Batches are uploaded in parallel without waiting for them to be applied.
+    When wait is set, the last batch is uploaded after the others, waiting for
+    it to be applied, and updates are applied in order, so every point is
+    searchable when this returns.
+    """
+    if sparse_vectors is not None and sparse_vectors_enabled():
+        vectors = [
+            {"": vector, SPARSE_VECTOR_NAME: sparse_vector}
+            for vector, sparse_vector in zip(vectors, sparse_vectors)
+        ]
+    n = BATCH_SIZE
+    batches = [
+        (ids[i : i + n], payloads[i : i + n], vectors[i : i + n])
+        for i in range(0, len(ids), n)
+    ]
+    if not batches:
+        return
+    last_batch = batches.pop() if wait else None
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        futures = [
+            executor.submit(store_batch_of_points, *batch, wait=False)
+            for batch in batches
+        ]
+        for future in futures:
+            future.result()
+    if last_batch:
+        store_batch_of_points(*last_batch, wait=True)
+
+
+def store_batch_of_points(ids, payloads, vectors, wait: bool = True):
     """Store a batch of points in the Qdrant collection."""
-    points = client.upsert(
+    if vectors and isinstance(vectors[0], dict):
+        # Named dense and sparse vectors of each point
+        points = [
+            models.PointStruct(id=id, payload=payload, vector=vector)
+            for id, payload, vector in zip(ids, payloads, vectors)
+        ]
+    else:
+        points = models.Batch(ids=ids, payloads=payloads, vectors=vectors)
+    result = client.upsert(
         collection_name=COLLECTION_NAME,
-        points=models.Batch(
-            ids=ids,
-            payloads=payloads,
-            vectors=vectors,
-        ),
+        points=points,
+        wait=wait,
+    )
+    return result
+
+
+def scroll_ids(filter) -> list:
+    """Get the ids of every point in the Qdrant collection matching a filter."""
+    ids = []
+    offset = None
+    while True:
+        records, offset = client.scroll(
+            collection_name=COLLECTION_NAME,
+            scroll_filter=filter,
+            limit=SCROLL_LIMIT,
+            offset=offset,
+            with_payload=False,
+            with_vectors=False,
+        )
+        ids.extend(str(record.id) for record in records)
+        if offset is None:
+            return ids
+
+
+def delete_points(ids):
+    """Delete points from the Qdrant collection."""
+    if not ids:
+        return None
+    return client.delete(
+        collection_name=COLLECTION_NAME,
+        points_selector=models.PointIdsList(points=ids),
     )
-    return points
 
 
 def search(query_vector, filter, limit: Optional[int] = MAX_CHUNKS_RETRIEVED):
@@ -54,15 +199,84 @@ def search(query_vector, filter, limit: Optional[int] = MAX_CHUNKS_RETRIEVED):
     return points
 
 
-def filter_by_chat_id(chat_id: str) -> models.Filter:
-    """Create a filter for the specified chat."""
-    return models.Filter(
-        must=[
+async def asearch(query_vector, filter, limit: Optional[int] = MAX_CHUNKS_RETRIEVED):
+    """Search for points in the Qdrant collection, without blocking the event loop."""
+    hits = await async_client.query_points(
+        collection_name=COLLECTION_NAME,
+        query=query_vector,
+        query_filter=filter,
+        limit=limit,
+    )
+    points = hits.points
+    return points
+
+
+async def asearch_hybrid(
+    query_vector,
+    query_sparse_vector,
+    filter,
+    limit: Optional[int] = MAX_CHUNKS_RETRIEVED,
+):
+    """
+    Search for points with the dense and the sparse vectors, in one request.
+
+    Returns:
+        the points found with the dense vector and with the sparse vector
+    """
+    responses = await async_client.query_batch_points(
+        collection_name=COLLECTION_NAME,
+        requests=[
+            models.QueryRequest(
+                query=query_vector, filter=filter, limit=limit, with_payload=True
+            ),
+            models.QueryRequest(
+                query=query_sparse_vector,
+                using=SPARSE_VECTOR_NAME,
+                filter=filter,
+                limit=limit,
+                with_payload=True,
+            ),
+        ],
+    )
+    return responses[0].points, responses[1].points
+
+
+def filter_by_corpora(
+    corpus_ids: List[str], chat_id: Optional[str] = None
+) -> models.Filter:
+    """
+    Create a filter for the corpora referenced by a chat.
+
+    Points indexed for a single chat, before corpora were shared, are
+    matched by the chat id.
+    """
+    conditions = [
+        models.FieldCondition(
+            key="corpus_id",
+            match=models.MatchAny(any=corpus_ids),
+        )
+    ]
+    if chat_id:
+        conditions.append(
             models.FieldCondition(
                 key="chat_id",
-                match=models.MatchValue(
-                    value=chat_id,
-                ),
+                match=models.MatchValue(value=chat_id),
             )
+        )
+    return models.Filter(should=conditions)
+
+
+def filter_by_url(corpus_id: str, url: str) -> models.Filter:
+    """Create a filter for the points of a page in the specified corpus."""
+    return models.Filter(
+        must=[
+            models.FieldCondition(
+                key="corpus_id",
+                match=models.MatchValue(value=corpus_id),
+            ),
+            models.FieldCondition(
+                key="url",
+                match=models.MatchValue(value=url),
+            ),
         ]
     )
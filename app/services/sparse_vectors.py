@@ -0,0 +1,63 @@
+import re
+import zlib
+from collections import Counter
+from typing import Iterator
+
+from config.config import settings
+from qdrant_client import models
+
+# BM25 parameters, the IDF is applied by Qdrant at query time
+K1 = 1.2
+B = 0.75
+# Chunks are about the chunk size long
+AVG_LENGTH = settings.default_chunk_size
+# Words, keeping dotted, dashed and namespaced identifiers whole
+WORD_PATTERN = re.compile(r"\w+(?:[.\-:]+\w+)*")
+# Boundaries of the parts of an identifier: separators and camelCase
+PART_PATTERN = re.compile(r"[._\-:]+|(?<=[a-z0-9])(?=[A-Z])")
+STOPWORDS = set(
+    "a an and are as at be by can do does for from how i if in is it of on or "
+    "that the this to was what when which with you".split()
+)
+
+
+def iter_terms(text: str) -> Iterator[str]:
+    """
+    Split a text in lowercase terms.
+
+    Identifiers such as function names, config keys or error codes are kept
+    whole, so they match exactly, and their parts are added too.
+    """
+    for match in WORD_PATTERN.finditer(text):
+        word = match.group()
+        term = word.lower()
+        if term in STOPWORDS:
+            continue
+        yield term
+        parts = PART_PATTERN.split(word)
+        if len(parts) > 1:
+            for part in parts:
+                part = part.lower()
+                if part and part not in STOPWORDS:
+                    yield part
+
+
+def term_index(term: str) -> int:
+    """Get the stable index of a term in the sparse vectors."""
+    return zlib.crc32(term.encode()) & 0x7FFFFFFF
+
+
+def document_sparse_vector(text: str) -> models.SparseVector:
+    """Get the BM25 term frequency weights of a document, as a sparse vector."""
+    counts = Counter(term_index(term) for term in iter_terms(text))
+    length = sum(counts.values())
+    norm = K1 * (1 - B + B * length / AVG_LENGTH)
+    indices = list(counts)
+    values = [counts[i] * (K1 + 1) / (counts[i] + norm) for i in indices]
+    return models.SparseVector(indices=indices, values=values)
+
+
+def query_sparse_vector(text: str) -> models.SparseVector:
+    """Get the terms of a query, as a sparse vector."""
+    indices = sorted({term_index(term) for term in iter_terms(text)})
+    return models.SparseVector(indices=indices, values=[1.0] * len(indices))
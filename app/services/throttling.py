@@ -0,0 +1,86 @@
+import random
+import threading
+import time
+from typing import Callable, TypeVar
+
+from botocore.exceptions import ClientError
+
+T = TypeVar("T")
+
+THROTTLING_CODES = (
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceUnavailableException",
+)
+
+
+class AdaptiveLimiter:
+    """
+    Limits the calls in flight, adapting the limit to the pushback of the service.
+
+    The limit grows by one after each successful call, up to the maximum,
+    and is halved every time the service throttles a call (AIMD).
+    """
+
+    def __init__(self, max_limit: int):
+        self.max_limit = max(1, max_limit)
+        self.limit = self.max_limit
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self):
+        with self.condition:
+            if self.limit < self.max_limit:
+                self.limit += 1
+                self.condition.notify_all()
+
+    def on_throttled(self):
+        with self.condition:
+            self.limit = max(1, self.limit // 2)
+            print(f"Throttled, reducing concurrency to {self.limit}")
+
+
+def is_throttling(error: Exception) -> bool:
+    """Check whether an error was caused by the service throttling the call."""
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code") in THROTTLING_CODES
+    # Some clients wrap the botocore error, keeping only its message
+    return any(code in str(error) for code in THROTTLING_CODES)
+
+
+def call_with_backoff(
+    func: Callable[[], T],
+    limiter: AdaptiveLimiter,
+    max_retries: int = 8,
+    base_delay: float = 0.5,
+    max_delay: float = 30.0,
+) -> T:
+    """
+    Call a function through a limiter, retrying throttled calls.
+
+    Retries wait with exponential backoff and full jitter.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            with limiter:
+                result = func()
+        except Exception as e:
+            if not is_throttling(e) or attempt == max_retries:
+                raise
+            limiter.on_throttled()
+            time.sleep(random.uniform(0, min(max_delay, base_delay * 2**attempt)))
+        else:
+            limiter.on_success()
+            return result
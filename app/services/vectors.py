@@ -0,0 +1,19 @@
+import math
+import operator
+from typing import List
+
+
+def normalize(vector: List[float]) -> List[float]:
+    """Scale a vector to unit length, so the cosine similarity is a dot product."""
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+def similarity(a: List[float], b: List[float]) -> float:
+    """Get the cosine similarity of two unit vectors."""
+    return sum(map(operator.mul, a, b))
+
+
+def centroid(vectors: List[List[float]]) -> List[float]:
+    """Get the unit length centroid of a list of unit vectors."""
+    return normalize([sum(values) / len(vectors) for values in zip(*vectors)])
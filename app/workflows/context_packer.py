@@ -0,0 +1,175 @@
+from typing import Dict, List, Optional, Tuple
+
+from config.config import settings
+from services.chunking import TOKEN_PATTERN, count_tokens, split_text
+from services.metrics import increment
+
+CONTEXT_TOKEN_BUDGET = settings.context_token_budget
+# Share of the terms of a passage found in a better ranked one to drop it
+DUPLICATE_CONTAINMENT = 0.9
+# Smallest truncated passage worth adding to the context
+MIN_TRUNCATED_TOKENS = 32
+# Blocks of the chunks, see services.chunking.token_chunk
+BLOCK_SEPARATOR = "\n\n"
+
+
+def pack_context(documents: List[Dict], budget: int = CONTEXT_TOKEN_BUDGET) -> str:
+    """
+    Assemble the context of a prompt from the retrieved documents.
+
+    The documents are ordered by score, adjacent chunks of the same section
+    are merged without their overlap, passages mostly contained in a better
+    ranked one are dropped, and the passages are added while they fit in the
+    token budget. A passage that does not fit is truncated at a block
+    boundary, or skipped if even its first block does not fit, and the next
+    passages are tried.
+    """
+    passages = merge_adjacent(sorted(documents, key=score, reverse=True))
+    passages = drop_duplicates(passages)
+    context = []
+    size = 0
+    for passage in passages:
+        text = render(passage)
+        tokens = count_tokens(text) + 1
+        if size + tokens > budget:
+            text = truncate(passage, budget - size)
+            if text:
+                context.append(text)
+                size += count_tokens(text) + 1
+            continue
+        context.append(text)
+        size += tokens
+    before = sum(count_tokens(document.get("text", "")) + 1 for document in documents)
+    print(
+        f"Context: {len(documents)} chunks, {before} tokens -> "
+        f"{len(context)} passages, {size} tokens"
+    )
+    increment("context_tokens_before", before)
+    increment("context_tokens_after", size)
+    return BLOCK_SEPARATOR.join(context)
+
+
+def score(document: Dict) -> float:
+    """
+    Get the rerank score of a document, or its search score if it was not
+    reranked. Documents without any keep their order.
+    """
+    if document.get("rerank_score") is not None:
+        return document["rerank_score"]
+    if document.get("score") is not None:
+        return document["score"]
+    return 0.0
+
+
+def merge_adjacent(documents: List[Dict]) -> List[Dict]:
+    """
+    Merge the consecutive chunks of a page, keeping the rank of the best one.
+
+    Chunks are consecutive by their order in the page. They are merged when
+    they share their heading path or overlap, as the order of the chunks left
+    unchanged by a re-indexing may be stale.
+    """
+    passages = []
+    for document in documents:
+        blocks = document.get("text", "").split(BLOCK_SEPARATOR)
+        headings = document.get("headings") or []
+        order = document.get("order")
+        for passage in passages:
+            if order is None or passage["url"] != document.get("url"):
+                continue
+            same_section = passage["headings"] == headings
+            if order == passage["last"] + 1:
+                merged = merge_blocks(passage["blocks"], blocks, same_section)
+                if merged:
+                    passage["blocks"], passage["last"] = merged, order
+                    break
+            if order == passage["first"] - 1:
+                merged = merge_blocks(blocks, passage["blocks"], same_section)
+                if merged:
+                    passage["blocks"], passage["first"] = merged, order
+                    passage["headings"] = headings
+                    break
+        else:
+            passages.append(
+                {
+                    "url": document.get("url"),
+                    "headings": headings,
+                    "first": order,
+                    "last": order,
+                    "blocks": blocks,
+                }
+            )
+    return passages
+
+
+def merge_blocks(
+    first: List[str], second: List[str], same_section: bool
+) -> Optional[List[str]]:
+    """
+    Concatenate the blocks of two chunks, removing the overlap of the second.
+
+    Chunks of different sections are only concatenated if they overlap.
+    """
+    for k in range(min(len(first), len(second)), 0, -1):
+        if first[-k:] == second[:k]:
+            return first + second[k:]
+    return first + second if same_section else None
+
+
+def terms(passage: Dict) -> set:
+    """Get the lowercase terms of a passage."""
+    text = BLOCK_SEPARATOR.join(passage["blocks"])
+    return {term.lower() for term in TOKEN_PATTERN.findall(text)}
+
+
+def drop_duplicates(passages: List[Dict]) -> List[Dict]:
+    """Drop the passages mostly contained in a better ranked one."""
+    kept: List[Tuple[Dict, set]] = []
+    for passage in passages:
+        passage_terms = terms(passage)
+        if not passage_terms:
+            continue
+        duplicated = any(
+            len(passage_terms & kept_terms) / len(passage_terms)
+            >= DUPLICATE_CONTAINMENT
+            for _, kept_terms in kept
+        )
+        if not duplicated:
+            kept.append((passage, passage_terms))
+    return [passage for passage, _ in kept]
+
+
+def render(passage: Dict, blocks: Optional[List[str]] = None) -> str:
+    """Render a passage under its heading path."""
+    text = BLOCK_SEPARATOR.join(passage["blocks"] if blocks is None else blocks)
+    if passage["headings"]:
+        return f"[{' > '.join(passage['headings'])}]\n{text}"
+    return text
+
+
+def truncate(passage: Dict, budget: int) -> str:
+    """
+    Truncate a passage to a token budget, keeping whole blocks.
+
+    If not even the first block fits, it is cut at a token boundary, unless
+    it is code, which is never cut.
+    """
+    if budget < MIN_TRUNCATED_TOKENS:
+        return ""
+    blocks = []
+    for block in passage["blocks"]:
+        if count_tokens(render(passage, blocks + [block])) + 1 > budget:
+            break
+        blocks.append(block)
+    if blocks:
+        return render(passage, blocks)
+    first = passage["blocks"][0]
+    if first.startswith("```"):
+        return ""
+    # Room for the heading path, the separator and the ellipsis
+    room = budget - count_tokens(render(passage, [""])) - 4
+    if room < 1:
+        return ""
+    pieces = split_text(first, room)
+    piece, _ = next(pieces, ("", 0))
+    return render(passage, [piece + " ..."]) if piece else ""
@@ -1,22 +1,83 @@
+import asyncio
+import time
+from typing import List
+
+from config.config import settings
+from langchain_core.callbacks.manager import adispatch_custom_event
+from langgraph.graph import END, START, StateGraph
 from schemas.states import QueryState
-from langgraph.graph import START, END, StateGraph
-from services.bedrock_llm import query_model
+from services.bedrock_embeddings import embed_query
+from services.bedrock_llm import aquery_model, astream_model
+from services.blocking import run_blocking
+from services.metrics import increment
+from workflows.context_packer import pack_context
+from workflows.intent_classifier import classify_intent
+from workflows.ragflow import rag_workflow, within_deadline
 from workflows.retriever import search_in_docs
-from workflows.ragflow import rag_workflow
-from typing import List
 
+RAG_DEADLINE = settings.rag_deadline_seconds
+INTENT_CLASSIFIER = settings.intent_classifier
+SINGLE_GENERATION = settings.single_generation
+# Custom event carrying the tokens of the answer, see stream_answer
+ANSWER_TOKEN_EVENT = "answer_token"
+# Answer when the deadline is reached before an answer is generated
+DEADLINE_ANSWER = (
+    "I could not answer the question in time. Please try again, or ask a "
+    "more specific question."
+)
+
+
+async def stream_answer(**kwargs) -> str:
+    """
+    Generate the answer for the user, dispatching its tokens as they arrive.
+
+    The tokens are received by the graph streaming clients as custom events,
+    see chat_controller.stream_query_documents.
+    """
+    tokens = []
+    async for token in astream_model(**kwargs):
+        tokens.append(token)
+        await adispatch_custom_event(ANSWER_TOKEN_EVENT, token)
+    return "".join(tokens).strip()
+
+
+async def process_query(state: QueryState) -> dict:
+    """
+    Extract the query from the state, and start the deadline of the answer.
 
-def process_query(state: QueryState) -> dict:
-    """Extract the query from the state."""
+    The query is embedded once, for both the intent classifier and the
+    retrieval, which run in parallel.
+    """
     query = state.get('question')
-    messages = state.get('messages', [])
-    messages.append({'role': 'user', 'content': query})
-    return {'question': query, 'messages': messages}
+    deadline = time.monotonic() + RAG_DEADLINE
+    query_vector = (await run_blocking(embed_query, query))[0]
+    # The query is not added to the messages, the prompts of the answer
+    # nodes already contain it
+    return {
+        'question': query,
+        'deadline': deadline,
+        'query_vector': query_vector,
+    }
 
 
-def classify_query(state: QueryState) -> dict:
+async def classify_query(state: QueryState) -> dict:
     """Analyzes the query from the state and returns an analysis."""
     query = state.get('question')
+    if INTENT_CLASSIFIER == 'local':
+        # Confident cases are classified locally, without an LLM round trip
+        try:
+            query_vector = state.get('query_vector')
+            if query_vector is None:
+                query_vector = (await run_blocking(embed_query, query))[0]
+            intent, margin = await run_blocking(classify_intent, query_vector)
+        except Exception as e:
+            print(f"Local intent classifier unavailable: {e}")
+            intent, margin = None, 0.0
+        if intent is not None:
+            increment('intent_local')
+            print(f"Query type classified locally: {intent} (margin {margin:.3f})")
+            return {'intent': intent}
+    increment('intent_llm')
     prompt = (
         "You are a conditional router node in a workflow graph. "
         "You can access to a knowledge base about the documentation of a library, "
@@ -30,11 +91,13 @@ def classify_query(state: QueryState) -> dict:
         "Respond with only one word: 'general', 'code', or 'clarification'.\n\n"
         f"User query: {query}"
     )
-    query_type = query_model(
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.0,
-        tokens=50
-    ).strip()
+    query_type = (
+        await aquery_model(
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.0,
+            tokens=50
+        )
+    ).strip().strip("'\".").lower()
     print(f"Query type selected: {query_type}")
     return {'intent': query_type}
 
@@ -53,7 +116,7 @@ def route_query(state: QueryState) -> str:
     return decision
 
 
-def ask_clarification(state: QueryState) -> dict:
+async def ask_clarification(state: QueryState) -> dict:
     """Generates an answer for the user, asking to clarify the query."""
     query = state.get('question')
     messages = state.get('messages', [])
@@ -68,18 +131,18 @@ def ask_clarification(state: QueryState) -> dict:
     )
     message = {"role": "user", "content": prompt}
     messages.append(message)
-    answer = query_model(
+    answer = await stream_answer(
         # messages=[{"role": "user", "content": prompt}],
         messages=messages,
         temperature=0.0,
         tokens=400
-    ).strip()
+    )
     messages.pop()
     messages.append({'role': 'assistant', 'content': answer})
     return {'answer': answer, 'messages': messages}
 
 
-def analyze_code(state: QueryState) -> dict:
+async def analyze_code(state: QueryState) -> dict:
     """Inspect the code fragment, and find errors or suggest improvements"""
     query = state.get('question')
     messages = state.get('messages', [])
@@ -93,34 +156,62 @@ def analyze_code(state: QueryState) -> dict:
         "Answer:"
     )
 
-    answer = query_model(
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.0,
-        tokens=400
+    answer = (
+        await aquery_model(
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.0,
+            tokens=400
+        )
     ).strip()
     messages.append({'role': 'assistant', 'content': answer})
     return {'answer': answer, 'messages': messages}
 
 
-def retrieve_info(state: QueryState) -> dict:
+async def retrieve_info(state: QueryState) -> dict:
     """Retrieves information based on the query from the state."""
     query = state.get('question')
     chat_id = state.get('chat_id', None)
-    points = search_in_docs(query, chat_id)
+    corpus_ids = state.get('corpus_ids', [])
+    points = await search_in_docs(query, chat_id, corpus_ids)
     documents = [point.payload for point in points]
     print(f"Documents: {documents}")
     return {'documents': documents}
 
 
-def generate_answer(state: QueryState) -> dict:
+async def prefetch_documents(state: QueryState) -> dict:
+    """
+    Retrieves the documents of the query while its intent is classified.
+
+    The retrieval node uses them instead of searching again for the same
+    question. They are thrown away if the query is routed elsewhere.
+    """
+    query = state.get('question')
+    try:
+        points = await search_in_docs(
+            query,
+            state.get('chat_id', None),
+            state.get('corpus_ids', []),
+            state.get('query_vector'),
+        )
+    except Exception as e:
+        # Retrieved again by the retrieval node, if the query is routed there
+        print(f"Could not prefetch the documents: {e}")
+        return {'prefetched': None}
+    documents = [point.payload for point in points]
+    return {'prefetched': {'question': query, 'documents': documents}}
+
+
+def join_query(state: QueryState) -> dict:
+    """Waits for the intent classification and the prefetched documents."""
+    return {}
+
+
+async def generate_answer(state: QueryState) -> dict:
     """Generates an answer based on the query and context from the state."""
     query = state.get('question')
     messages = state.get('messages')
     documents = state.get('documents', [])
-    documents_text = ""
-    for chunk in documents:
-        chunk_text = chunk.get('text')
-        documents_text += f"{chunk_text}\n"
+    documents_text = pack_context(documents)
     prompt = (
         "You are an assistant for question-answering tasks. "
         "Use the following pieces of retrieved context to answer the question. "
@@ -132,11 +223,34 @@ def generate_answer(state: QueryState) -> dict:
     )
     message = {"role": "user", "content": prompt}
     messages.append(message)
-    answer = query_model(
-        messages=messages,
-        temperature=0.0
-    ).strip()
-    return {'answer': answer, 'messages': messages}
+    try:
+        answer = await within_deadline(
+            state,
+            stream_answer(
+                messages=messages,
+                temperature=0.0
+            ),
+        )
+    except asyncio.TimeoutError:
+        print("---GENERATE ANSWER: DEADLINE REACHED---")
+        increment('rag_budget_exhausted_deadline')
+        return {
+            'answer': DEADLINE_ANSWER,
+            'messages': messages,
+            'generation_grade': None,
+            'low_confidence': True,
+        }
+    # Generated again after the RAG loop, this answer was not graded
+    return {'answer': answer, 'messages': messages, 'generation_grade': None}
+
+
+def route_answer(state: QueryState) -> str:
+    """Routes to the answer generation, unless the RAG subgraph produced one."""
+    if SINGLE_GENERATION and state.get('answer'):
+        # Already graded and checked for hallucinations, generating it again
+        # would return an unchecked answer
+        return "answered"
+    return "generate"
 
 
 def format_code(state: QueryState) -> dict:
@@ -147,7 +261,12 @@ def format_code(state: QueryState) -> dict:
 
 
 def add_to_memory(state: QueryState) -> List[dict]:
-    """Adds the query and answer to memory for future reference."""
+    """
+    Adds the query and answer to the messages of the state.
+
+    The memory of the next queries is loaded from the saved messages, see
+    chat_controller.load_memory.
+    """
     query = state.get('question')
     answer = state.get('answer')
     messages = state.get('messages', [])
@@ -162,6 +281,8 @@ query_graph = StateGraph(QueryState)
 query_graph.add_node("process_query", process_query)
 query_graph.add_node("analyze_query", classify_query)
 query_graph.add_node("route_query", route_query)
+query_graph.add_node("prefetch_documents", prefetch_documents)
+query_graph.add_node("join_query", join_query)
 query_graph.add_node("retrieve_info", rag_workflow.compile())
 query_graph.add_node("generate_answer", generate_answer)
 query_graph.add_node("add_to_memory", add_to_memory)
@@ -169,9 +290,12 @@ query_graph.add_node("ask_clarification", ask_clarification)
 
 # Build graph
 query_graph.add_edge(START, "process_query")
+# Classify and retrieve in parallel, nearly every query is routed to retrieval
 query_graph.add_edge("process_query", "analyze_query")
+query_graph.add_edge("process_query", "prefetch_documents")
+query_graph.add_edge(["analyze_query", "prefetch_documents"], "join_query")
 query_graph.add_conditional_edges(
-    "analyze_query",
+    "join_query",
     route_query,
     {
         "retrieval": "retrieve_info",
@@ -179,7 +303,14 @@ query_graph.add_conditional_edges(
         "clarification": "ask_clarification"
     }
 )
-query_graph.add_edge("retrieve_info", "generate_answer")
+query_graph.add_conditional_edges(
+    "retrieve_info",
+    route_answer,
+    {
+        "generate": "generate_answer",
+        "answered": "add_to_memory",
+    }
+)
 query_graph.add_edge("generate_answer", "add_to_memory")
 query_graph.add_edge("ask_clarification", "add_to_memory")
 query_graph.add_edge("add_to_memory", END)
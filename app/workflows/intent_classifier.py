@@ -0,0 +1,79 @@
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from config.config import settings
+from services.bedrock_embeddings import embed_queries
+from services.vectors import centroid, normalize, similarity
+
+INTENT_MIN_MARGIN = settings.intent_min_margin
+
+# Labelled examples of each intent, their centroids classify the queries
+INTENT_EXAMPLES = {
+    "general": [
+        "How do I install the library?",
+        "How do I configure authentication?",
+        "What parameters does the client accept?",
+        "How can I set a timeout for the requests?",
+        "Which versions of Python are supported?",
+        "How do I paginate the results of a list endpoint?",
+        "What is the difference between the sync and the async clients?",
+        "What does the rate limit error mean?",
+        "Is there a way to retry failed requests?",
+        "How do I upload a file?",
+    ],
+    "code": [
+        "Why does this code raise an exception? client = Client(); client.get()",
+        "What is wrong with this function: def fetch(id): return api.get(id",
+        "Can you fix this snippet? ```response = requests.post(url, data)```",
+        "This code returns None, why? result = db.query(User).first()",
+        "How can I improve this code: for i in range(len(items)): print(items[i])",
+        "I get a TypeError running `app.run(port='8000')`, what should I change?",
+        "Refactor this class to use the async client",
+        "Is this the right way to call it? await client.send(message, timeout=5)",
+    ],
+    "clarification": [
+        "help",
+        "it does not work",
+        "what about the other one?",
+        "hi",
+        "can you explain?",
+        "error",
+        "and then?",
+        "how?",
+        "the thing I asked before",
+        "why",
+    ],
+}
+
+centroids: Dict[str, List[float]] = {}
+centroids_lock = threading.Lock()
+
+
+def load_centroids() -> Dict[str, List[float]]:
+    """Get the centroids of the intent examples, embedding them once."""
+    with centroids_lock:
+        if not centroids:
+            for intent, examples in INTENT_EXAMPLES.items():
+                vectors = [normalize(v) for v in embed_queries(examples)]
+                centroids[intent] = centroid(vectors)
+    return centroids
+
+
+def classify_intent(query_vector: List[float]) -> Tuple[Optional[str], float]:
+    """
+    Classify the intent of a query by the nearest centroid of its embedding.
+
+    Returns:
+        the intent, or None if the margin between the nearest centroid and
+        the next one is under the confidence threshold, and the margin
+    """
+    vector = normalize(query_vector)
+    scores = sorted(
+        ((similarity(vector, c), intent) for intent, c in load_centroids().items()),
+        reverse=True,
+    )
+    (best_score, intent), (next_score, _) = scores[0], scores[1]
+    margin = best_score - next_score
+    if margin < INTENT_MIN_MARGIN:
+        return None, margin
+    return intent, margin
@@ -1,20 +1,56 @@
+import asyncio
+import time
 from pprint import pprint
 
+from config.config import settings
+from langchain_core.callbacks.manager import adispatch_custom_event
 from langgraph.graph import END, START, StateGraph
 from schemas.states import RagState
-from services.bedrock_llm import query_model
+from services.bedrock_llm import astream_model
+from services.metrics import increment
 
 from .retriever import search_in_docs
 from .utils import (
     format_docs,
-    grade_answer,
-    grade_hallucination,
-    grade_retrieval,
+    grade_grounded_answer,
+    grade_retrievals,
     rewrite_question,
 )
 
+MAX_REWRITES = settings.rag_max_rewrites
+MAX_REGENERATIONS = settings.rag_max_regenerations
+RERANK_ACCEPT_THRESHOLD = settings.rerank_accept_threshold
+RERANK_REJECT_THRESHOLD = settings.rerank_reject_threshold
+# Rank of the generation grades, to keep the best answer
+GRADE_RANKS = {"not supported": 0, "not useful": 1, "useful": 2}
+# Custom event carrying the tokens of an answer before it is graded
+DRAFT_TOKEN_EVENT = "draft_token"
 
-def retrieve(state: RagState):
+
+async def within_deadline(state, awaitable):
+    """
+    Await a call of a node, raising asyncio.TimeoutError if the deadline of
+    the answer is reached first.
+    """
+    deadline = state.get("deadline")
+    if deadline is None:
+        return await awaitable
+    return await asyncio.wait_for(awaitable, max(deadline - time.monotonic(), 0))
+
+
+async def stream_draft(**kwargs) -> str:
+    """
+    Generate an answer, dispatching its tokens as they arrive as a draft, which
+    the grading may reject, see chat_controller.stream_query_documents.
+    """
+    tokens = []
+    async for token in astream_model(**kwargs):
+        tokens.append(token)
+        await adispatch_custom_event(DRAFT_TOKEN_EVENT, token)
+    return "".join(tokens)
+
+
+async def retrieve(state: RagState):
     """
     Retrieve documents
 
@@ -27,12 +63,24 @@ def retrieve(state: RagState):
     print("---RETRIEVE---")
     question = state.get("question")
     chat_id = state.get("chat_id")
-    points = search_in_docs(question, chat_id)
-    documents = [point.payload for point in points]
-    return {"documents": documents, "question": question}
-
-
-def generate(state):
+    corpus_ids = state.get("corpus_ids", [])
+    prefetched = state.get("prefetched")
+    if prefetched and prefetched.get("question") == question:
+        # Retrieved while the intent of the question was classified
+        documents = prefetched.get("documents")
+    else:
+        try:
+            points = await within_deadline(
+                state, search_in_docs(question, chat_id, corpus_ids)
+            )
+        except asyncio.TimeoutError:
+            print("---RETRIEVE: DEADLINE REACHED---")
+            points = []
+        documents = [point.payload for point in points]
+    return {"documents": documents, "question": question, "prefetched": None}
+
+
+async def generate(state):
     """
     Generate answer
 
@@ -57,42 +105,111 @@ def generate(state):
         f"Context: {docs_txt}\n"
         "Answer:"
     )
-    answer = query_model(
-        messages=[{"role": "user", "content": prompt}], temperature=0.0, tokens=400
-    ).strip()
-    return {"documents": documents, "question": question, "answer": answer}
-
-
-def grade_documents(state):
+    # Follow-up questions are answered with the memory of the chat
+    messages = state.get("messages") or []
+    # Only the generations after an answer not supported by the documents are
+    # regenerations, the ones after a rewrite of the question are not
+    regenerations = state.get("regenerations", 0)
+    if state.get("generation_grade") == "not supported":
+        regenerations += 1
+    try:
+        answer = await within_deadline(
+            state,
+            stream_draft(
+                messages=messages + [{"role": "user", "content": prompt}],
+                temperature=0.0,
+                tokens=400,
+            ),
+        )
+    except asyncio.TimeoutError:
+        print("---GENERATE: DEADLINE REACHED---")
+        # Not graded, the loop stops with the best answer so far
+        return {"generation_grade": None, "regenerations": regenerations}
+    answer = answer.strip()
+    increment("rag_generations")
+    return {
+        "documents": documents,
+        "question": question,
+        "answer": answer,
+        "context": docs_txt,
+        "regenerations": regenerations,
+    }
+
+
+async def grade_documents(state):
     """Determines whether the retrieved documents are relevant to the question."""
 
     print("---CHECK DOCUMENT RELEVANCE TO QUESTION---")
     question = state.get("question")
     documents = state.get("documents")
 
-    # Score each doc
-    filtered_docs = []
+    # Trust the rerank scores at both ends, only the middle band is graded
+    accepted, uncertain = [], []
     for d in documents:
-        score = grade_retrieval(question, d.get("text"))
-        grade = score.binary_score
+        rerank_score = d.get("rerank_score")
+        if rerank_score is not None and rerank_score >= RERANK_ACCEPT_THRESHOLD:
+            print("---GRADE: DOCUMENT RELEVANT BY RERANK SCORE---")
+            accepted.append(d)
+        elif rerank_score is not None and rerank_score < RERANK_REJECT_THRESHOLD:
+            print("---GRADE: DOCUMENT NOT RELEVANT BY RERANK SCORE---")
+        else:
+            uncertain.append(d)
+    rejected = len(documents) - len(accepted) - len(uncertain)
+    increment("documents_accepted_by_score", len(accepted))
+    increment("documents_rejected_by_score", rejected)
+    increment("documents_graded", len(uncertain))
+
+    # Score the uncertain docs
+    try:
+        grades = await within_deadline(
+            state, grade_retrievals(question, [d.get("text") for d in uncertain])
+        )
+    except asyncio.TimeoutError:
+        print("---GRADE: DEADLINE REACHED, UNCERTAIN DOCUMENTS NOT RELEVANT---")
+        grades = []
+    for d, grade in zip(uncertain, grades):
         if grade == "yes":
             print("---GRADE: DOCUMENT RELEVANT---")
-            filtered_docs.append(d)
+            accepted.append(d)
         else:
             print("---GRADE: DOCUMENT NOT RELEVANT---")
             continue
+    # Keep the retrieval order
+    accepted_ids = {id(d) for d in accepted}
+    filtered_docs = [d for d in documents if id(d) in accepted_ids]
     return {"documents": filtered_docs, "question": question}
 
 
-def transform_query(state):
+async def transform_query(state):
     """Transform the query to produce a better question."""
 
     print("---TRANSFORM QUERY---")
     question = state.get("question")
     documents = state.get("documents")
 
-    better_question = rewrite_question(question)
-    return {"documents": documents, "question": better_question}
+    try:
+        better_question = await within_deadline(state, rewrite_question(question))
+    except asyncio.TimeoutError:
+        print("---TRANSFORM QUERY: DEADLINE REACHED---")
+        better_question = question
+    increment("rag_rewrites")
+    return {
+        "documents": documents,
+        "question": better_question,
+        "rewrites": state.get("rewrites", 0) + 1,
+    }
+
+
+def budget_exhausted(state, counter: str, limit: int) -> bool:
+    """Determines whether the deadline or the budget of a counter is exhausted."""
+    deadline = state.get("deadline")
+    if deadline is not None and time.monotonic() >= deadline:
+        increment("rag_budget_exhausted_deadline")
+        return True
+    if state.get(counter, 0) >= limit:
+        increment(f"rag_budget_exhausted_{counter}")
+        return True
+    return False
 
 
 def decide_to_generate(state):
@@ -103,6 +220,9 @@ def decide_to_generate(state):
     filtered_documents = state.get("documents")
 
     if not filtered_documents:
+        if budget_exhausted(state, "rewrites", MAX_REWRITES):
+            print("---DECISION: NO RELEVANT DOCUMENTS, BUDGET EXHAUSTED, STOP---")
+            return "stop"
         print(
             "---DECISION: ALL DOCUMENTS ARE NOT RELEVANT TO QUESTION, TRANSFORM QUERY---"
         )
@@ -112,36 +232,78 @@ def decide_to_generate(state):
         return "generate"
 
 
-def grade_generation_v_documents_and_question(state):
+async def grade_generation(state):
     """
     Determines whether the generation is grounded in the document
     and answers question.
     """
 
-    print("---CHECK HALLUCINATIONS---")
+    print("---CHECK HALLUCINATIONS AND GRADE GENERATION vs QUESTION---")
     question = state.get("question")
-    documents = state.get("documents")
     answer = state.get("answer")
+    # Graded against the same context the answer was generated from
+    context = state.get("context") or format_docs(state.get("documents"))
 
-    score = grade_hallucination(documents, answer)
-    grade = score.binary_score
+    try:
+        grounded, addresses_question = await within_deadline(
+            state, grade_grounded_answer(question, context, answer)
+        )
+    except asyncio.TimeoutError:
+        print("---DECISION: DEADLINE REACHED, GENERATION NOT GRADED---")
+        return {"generation_grade": None}
 
     # Check hallucination
-    if grade == "yes":
+    if grounded == "yes":
         print("---DECISION: GENERATION IS GROUNDED IN DOCUMENTS---")
         # Check question-answering
-        print("---GRADE GENERATION vs QUESTION---")
-        score = grade_answer(question, answer)
-        grade = score.binary_score
-        if grade == "yes":
+        if addresses_question == "yes":
             print("---DECISION: GENERATION ADDRESSES QUESTION---")
-            return "useful"
+            generation_grade = "useful"
         else:
             print("---DECISION: GENERATION DOES NOT ADDRESS QUESTION---")
-            return "not useful"
+            generation_grade = "not useful"
     else:
         pprint("---DECISION: GENERATION IS NOT GROUNDED IN DOCUMENTS, RE-TRY---")
-        return "not supported"
+        generation_grade = "not supported"
+
+    update = {"generation_grade": generation_grade}
+    # Keep the best answer so far, in case a budget is exhausted
+    best_grade = state.get("best_grade")
+    if best_grade is None or GRADE_RANKS[generation_grade] > GRADE_RANKS[best_grade]:
+        update.update({"best_answer": answer, "best_grade": generation_grade})
+    return update
+
+
+def decide_after_generation(state):
+    """Determines whether to finish, re-generate the answer or the question."""
+
+    generation_grade = state.get("generation_grade")
+    if generation_grade == "useful":
+        return "useful"
+    if generation_grade is None:
+        print("---DECISION: DEADLINE REACHED, STOP---")
+        increment("rag_budget_exhausted_deadline")
+        return "stop"
+    if generation_grade == "not supported":
+        counter, limit = "regenerations", MAX_REGENERATIONS
+    else:
+        counter, limit = "rewrites", MAX_REWRITES
+    if budget_exhausted(state, counter, limit):
+        print("---DECISION: BUDGET EXHAUSTED, STOP---")
+        return "stop"
+    return generation_grade
+
+
+def stop(state):
+    """Stops the loop, returning the best answer so far as low-confidence."""
+
+    print("---STOP: RETURN BEST ANSWER AS LOW-CONFIDENCE---")
+    increment("rag_budget_exhausted")
+    return {
+        "answer": state.get("best_answer"),
+        "generation_grade": state.get("best_grade"),
+        "low_confidence": True,
+    }
 
 
 rag_workflow = StateGraph(RagState)
@@ -150,7 +312,9 @@ rag_workflow = StateGraph(RagState)
 rag_workflow.add_node("retrieve", retrieve)
 rag_workflow.add_node("grade_documents", grade_documents)
 rag_workflow.add_node("generate", generate)
+rag_workflow.add_node("grade_generation", grade_generation)
 rag_workflow.add_node("transform_query", transform_query)
+rag_workflow.add_node("stop", stop)
 
 # Build graph
 rag_workflow.add_edge(START, "retrieve")
@@ -161,18 +325,22 @@ rag_workflow.add_conditional_edges(
     {
         "transform_query": "transform_query",
         "generate": "generate",
+        "stop": "stop",
     },
 )
 rag_workflow.add_edge("transform_query", "retrieve")
+rag_workflow.add_edge("generate", "grade_generation")
 rag_workflow.add_conditional_edges(
-    "generate",
-    grade_generation_v_documents_and_question,
+    "grade_generation",
+    decide_after_generation,
     {
         "not supported": "generate",
         "useful": END,
         "not useful": "transform_query",
+        "stop": "stop",
     },
 )
+rag_workflow.add_edge("stop", END)
 
 # Compile
 compiled_rag_graph = rag_workflow.compile()
@@ -1,25 +1,97 @@
 from config.config import settings
 from services.bedrock_embeddings import embed_query, rerank_texts
-from services.qdrant import filter_by_chat_id, search
+from services.blocking import run_blocking
+from services.metrics import increment
+from services.qdrant import (
+    asearch,
+    asearch_hybrid,
+    filter_by_corpora,
+    sparse_vectors_enabled,
+)
+from services.sparse_vectors import query_sparse_vector
 
 MAX_CHUNKS_RETRIEVED = settings.max_chunks_retrieved
 MAX_CHUNKS_RERANKED = settings.max_chunks_reranked
+HYBRID_SEARCH = settings.hybrid_search
+RERANK_SKIP_TOP_K = settings.rerank_skip_top_k
+RERANK_ACCEPT_THRESHOLD = settings.rerank_accept_threshold
+# Usual constant of the reciprocal rank fusion
+RRF_K = 60
 
 
-def search_in_docs(query, chat_id):
-    """Search for the question in the documentation."""
-    query_vector = embed_query(query)[0]
-    query_filter = filter_by_chat_id(chat_id)
-    points = search(
-        query_vector,
-        query_filter,
-        MAX_CHUNKS_RETRIEVED,
-    )
+async def search_in_docs(query, chat_id, corpus_ids, query_vector=None):
+    """
+    Search for the question in the documentation of the chat corpora.
+
+    With the hybrid search, the dense and sparse results are fused by their
+    ranks, and the rerank is skipped when both searches agree on the best
+    results. Those results are then given the rerank score that accepts them
+    without LLM grading.
+    """
+    if query_vector is None:
+        # Bedrock and the embeddings cache have no async clients
+        query_vector = (await run_blocking(embed_query, query))[0]
+    query_filter = filter_by_corpora(corpus_ids, chat_id)
+    confident = False
+    sparse_vector = query_sparse_vector(query)
+    hybrid = HYBRID_SEARCH and sparse_vector.indices
+    if hybrid and await run_blocking(sparse_vectors_enabled):
+        dense_points, sparse_points = await asearch_hybrid(
+            query_vector,
+            sparse_vector,
+            query_filter,
+            MAX_CHUNKS_RETRIEVED,
+        )
+        points = reciprocal_rank_fusion([dense_points, sparse_points])
+        confident = agree(dense_points, sparse_points, RERANK_SKIP_TOP_K)
+    else:
+        points = await asearch(
+            query_vector,
+            query_filter,
+            MAX_CHUNKS_RETRIEVED,
+        )
     print(f"Found {len(points)} points")
+    for point in points:
+        point.payload["score"] = point.score
+    if confident:
+        increment("rerank_skipped")
+        # Both searches rank them first, they are accepted like documents
+        # the rerank scores as relevant, see ragflow.grade_documents
+        for point in points[:RERANK_SKIP_TOP_K]:
+            point.payload["rerank_score"] = RERANK_ACCEPT_THRESHOLD
+        return points[:MAX_CHUNKS_RERANKED]
     try:
         texts = [point.payload["text"] for point in points]
-        reranked = rerank_texts(query, texts, MAX_CHUNKS_RERANKED)
+        reranked = await run_blocking(rerank_texts, query, texts, MAX_CHUNKS_RERANKED)
+        increment("rerank_calls")
         points = [points[r["index"]] for r in reranked]
+        # Carried to the grading of the documents, see ragflow.grade_documents
+        for point, r in zip(points, reranked):
+            point.payload["rerank_score"] = r["score"]
         return points
     except Exception as e:
-        return points
+        print(f"Rerank failed, keeping the search order: {e}")
+        increment("rerank_failed")
+        return points[:MAX_CHUNKS_RERANKED]
+
+
+def reciprocal_rank_fusion(rankings, k: int = RRF_K):
+    """Fuse rankings of points, scoring each point by the sum of 1 / (k + rank)."""
+    scores = {}
+    points = {}
+    for ranking in rankings:
+        for rank, point in enumerate(ranking, start=1):
+            scores[point.id] = scores.get(point.id, 0.0) + 1 / (k + rank)
+            points.setdefault(point.id, point)
+    fused = sorted(points.values(), key=lambda point: scores[point.id], reverse=True)
+    for point in fused:
+        point.score = scores[point.id]
+    return fused
+
+
+def agree(dense_points, sparse_points, top_k: int) -> bool:
+    """Check whether two rankings have the same top k points."""
+    if top_k <= 0 or len(dense_points) < top_k or len(sparse_points) < top_k:
+        return False
+    dense_ids = {point.id for point in dense_points[:top_k]}
+    return dense_ids == {point.id for point in sparse_points[:top_k]}
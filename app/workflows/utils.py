@@ -1,98 +1,227 @@
 from config.config import settings
 from langchain.prompts import ChatPromptTemplate
-from langchain_google_genai import ChatGoogleGenerativeAI
-from schemas.schemas import GradeAnswer, GradeDocuments, GradeHallucinations
 from langchain_core.output_parsers import StrOutputParser
+from langchain_google_genai import ChatGoogleGenerativeAI
+from schemas.schemas import (
+    GradeAnswer,
+    GradeDocuments,
+    GradeDocumentsList,
+    GradeGeneration,
+    GradeHallucinations,
+)
+from workflows.context_packer import pack_context
 
 GOOGLE_API_KEY = settings.google_api_key
+GRADING_MODE = settings.grading_mode
+GRADING_CONCURRENCY = settings.grading_concurrency
 
 llm = ChatGoogleGenerativeAI(
     model="gemini-2.5-flash", google_api_key=GOOGLE_API_KEY, temperature=0
 )
 
 
-def grade_retrieval(question, document):
-    structured_llm_grader = llm.with_structured_output(GradeDocuments)
-
-    system = """You are a grader assessing relevance of a retrieved document to a user question. \n 
-        If the document contains keyword(s) or semantic meaning related to the user question, grade it as relevant. \n
-        It does not need to be a stringent test. The goal is to filter out erroneous retrievals. \n
-        Give a binary score 'yes' or 'no' score to indicate whether the document is relevant to the question."""
-    grade_prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", system),
-            (
-                "human",
-                "Retrieved document: \n\n {document} \n\n User question: {question}",
-            ),
-        ]
-    )
+retrieval_system = """You are a grader assessing relevance of a retrieved document to a user question. \n 
+    If the document contains keyword(s) or semantic meaning related to the user question, grade it as relevant. \n
+    It does not need to be a stringent test. The goal is to filter out erroneous retrievals. \n
+    Give a binary score 'yes' or 'no' score to indicate whether the document is relevant to the question."""
+grade_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", retrieval_system),
+        (
+            "human",
+            "Retrieved document: \n\n {document} \n\n User question: {question}",
+        ),
+    ]
+)
+retrieval_grader = grade_prompt | llm.with_structured_output(GradeDocuments)
+
+list_retrieval_system = (
+    "You are a grader assessing relevance of a list of retrieved documents to a "
+    "user question. \n"
+    "If a document contains keyword(s) or semantic meaning related to the user "
+    "question, grade it as relevant. \n"
+    "It does not need to be a stringent test. The goal is to filter out "
+    "erroneous retrievals. \n"
+    "Give a binary score 'yes' or 'no' for each document, identified by its "
+    "index in the list."
+)
+list_grade_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", list_retrieval_system),
+        (
+            "human",
+            "Retrieved documents: \n\n {documents} \n\n User question: {question}",
+        ),
+    ]
+)
+list_retrieval_grader = list_grade_prompt | llm.with_structured_output(
+    GradeDocumentsList
+)
 
-    retrieval_grader = grade_prompt | structured_llm_grader
-    answer = retrieval_grader.invoke({"question": question, "document": document})
-    return answer
 
+async def grade_retrievals(question, documents, mode=GRADING_MODE):
+    """
+    Grade the relevance of a list of documents to the question.
+
+    In 'listwise' mode all the documents are graded in a single call. The
+    documents it misses, or all of them if the call fails, are graded one by
+    one, concurrently.
+
+    Returns:
+        the binary scores, 'yes' or 'no', in the order of the documents
+    """
+    if not documents:
+        return []
+    grades = {}
+    if mode == "listwise":
+        try:
+            grades = await grade_retrievals_listwise(question, documents)
+        except Exception as e:
+            print(f"---LISTWISE GRADING FAILED, GRADING EACH DOCUMENT: {e}---")
+    missing = [i for i in range(len(documents)) if i not in grades]
+    if missing:
+        if grades:
+            print(f"---LISTWISE GRADING MISSED {missing}, GRADING THEM---")
+        scores = await retrieval_grader.abatch(
+            [{"question": question, "document": documents[i]} for i in missing],
+            config={"max_concurrency": GRADING_CONCURRENCY},
+        )
+        for i, score in zip(missing, scores):
+            grades[i] = score.binary_score
+    return [grades[i] for i in range(len(documents))]
+
+
+async def grade_retrievals_listwise(question, documents):
+    """
+    Grade the relevance of a list of documents in a single call.
+
+    Returns:
+        the binary scores by index of the documents, which may miss some
+    """
+    documents_text = "\n\n".join(
+        f"[{i}] {document}" for i, document in enumerate(documents)
+    )
+    answer = await list_retrieval_grader.ainvoke(
+        {"question": question, "documents": documents_text}
+    )
+    return {
+        grade.index: grade.binary_score
+        for grade in answer.grades
+        if 0 <= grade.index < len(documents)
+    }
+
+
+hallucination_system = """You are a grader assessing whether an LLM generation is grounded in / supported by a set of retrieved facts. \n 
+    Give a binary score 'yes' or 'no'. 'Yes' means that the answer is grounded in / supported by the set of facts."""
+hallucination_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", hallucination_system),
+        (
+            "human",
+            "Set of facts: \n\n {documents} \n\n LLM generation: {generation}",
+        ),
+    ]
+)
+hallucination_grader = hallucination_prompt | llm.with_structured_output(
+    GradeHallucinations
+)
 
-def grade_hallucination(documents, generation):
-    structured_llm_grader = llm.with_structured_output(GradeHallucinations)
+answer_system = """You are a grader assessing whether an answer addresses / resolves a question \n 
+    Give a binary score 'yes' or 'no'. Yes' means that the answer resolves the question."""
+answer_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", answer_system),
+        (
+            "human",
+            "User question: \n\n {question} \n\n LLM generation: {generation}",
+        ),
+    ]
+)
+answer_grader = answer_prompt | llm.with_structured_output(GradeAnswer)
+
+generation_system = (
+    "You are a grader assessing an LLM generation that answers a user question "
+    "from a set of retrieved facts. \n"
+    "First, give a binary score 'yes' or 'no' to indicate whether the generation "
+    "is grounded in / supported by the set of facts. \n"
+    "Then, give a binary score 'yes' or 'no' to indicate whether the generation "
+    "addresses / resolves the question. \n"
+    "Give a short reason for each score."
+)
+generation_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", generation_system),
+        (
+            "human",
+            "Set of facts: \n\n {documents} \n\n User question: {question} \n\n "
+            "LLM generation: {generation}",
+        ),
+    ]
+)
+generation_grader = generation_prompt | llm.with_structured_output(GradeGeneration)
+
+re_write_system = """You a question re-writer that converts an input question to a better version that is optimized \n 
+    for vectorstore retrieval. Look at the input and try to reason about the underlying semantic intent / meaning."""
+re_write_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", re_write_system),
+        (
+            "human",
+            "Here is the initial question: \n\n {question} \n Formulate an improved question.",
+        ),
+    ]
+)
+question_rewriter = re_write_prompt | llm | StrOutputParser()
 
-    system = """You are a grader assessing whether an LLM generation is grounded in / supported by a set of retrieved facts. \n 
-        Give a binary score 'yes' or 'no'. 'Yes' means that the answer is grounded in / supported by the set of facts."""
-    hallucination_prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", system),
-            (
-                "human",
-                "Set of facts: \n\n {documents} \n\n LLM generation: {generation}",
-            ),
-        ]
-    )
 
-    hallucination_grader = hallucination_prompt | structured_llm_grader
-    answer = hallucination_grader.invoke(
+async def grade_hallucination(documents, generation):
+    answer = await hallucination_grader.ainvoke(
         {"documents": documents, "generation": generation}
     )
     return answer
 
 
-def grade_answer(question, generation):
-    structured_llm_grader = llm.with_structured_output(GradeAnswer)
-
-    system = """You are a grader assessing whether an answer addresses / resolves a question \n 
-        Give a binary score 'yes' or 'no'. Yes' means that the answer resolves the question."""
-    answer_prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", system),
-            (
-                "human",
-                "User question: \n\n {question} \n\n LLM generation: {generation}",
-            ),
-        ]
+async def grade_answer(question, generation):
+    answer = await answer_grader.ainvoke(
+        {"question": question, "generation": generation}
     )
-
-    answer_grader = answer_prompt | structured_llm_grader
-    answer = answer_grader.invoke({"question": question, "generation": generation})
     return answer
 
 
-def rewrite_question(question):
-    system = """You a question re-writer that converts an input question to a better version that is optimized \n 
-        for vectorstore retrieval. Look at the input and try to reason about the underlying semantic intent / meaning."""
-    re_write_prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", system),
-            (
-                "human",
-                "Here is the initial question: \n\n {question} \n Formulate an improved question.",
-            ),
-        ]
-    )
-
-    question_rewriter = re_write_prompt | llm | StrOutputParser()
-    answer = question_rewriter.invoke({"question": question})
+async def grade_grounded_answer(question, documents, generation):
+    """
+    Grade whether the generation is grounded in the documents and whether it
+    addresses the question, in a single call.
+
+    Falls back to the separate graders if the call fails.
+
+    Returns:
+        the binary scores, 'yes' or 'no', grounded and addresses question
+    """
+    try:
+        answer = await generation_grader.ainvoke(
+            {"documents": documents, "question": question, "generation": generation}
+        )
+        print(f"---GROUNDED: {answer.grounded}, {answer.grounded_reason}---")
+        print(
+            f"---ADDRESSES QUESTION: {answer.addresses_question}, "
+            f"{answer.addresses_question_reason}---"
+        )
+        return answer.grounded, answer.addresses_question
+    except Exception as e:
+        print(f"---COMBINED GRADING FAILED, GRADING SEPARATELY: {e}---")
+    grounded = (await grade_hallucination(documents, generation)).binary_score
+    if grounded != "yes":
+        return grounded, None
+    addresses_question = (await grade_answer(question, generation)).binary_score
+    return grounded, addresses_question
+
+
+async def rewrite_question(question):
+    answer = await question_rewriter.ainvoke({"question": question})
     return answer
 
 
 # Post-processing
 def format_docs(docs):
-    return "\n\n".join(doc.get("text") for doc in docs)
+    return pack_context(docs)
@@ -0,0 +1,107 @@
+"""
+Benchmark of the latency of the chat history pages on a long chat.
+
+Usage, against the Postgres of docker-compose, with the variables of app/.env:
+    PYTHONPATH=app python benchmarks/chat_history_benchmark.py --messages 100000
+
+Creates a chat with the given number of messages, then measures the latency
+of the first, a middle and the last page of its history, followed by the
+cursor, and of loading the whole history as before. The index is created
+first if the database predates it. With the keyset on the
+(chat_id, created_at, id) index the latency of a page stays flat whatever its
+depth in the chat. The chat and its messages are deleted.
+"""
+
+import argparse
+import datetime
+import statistics
+import time
+import uuid
+
+from controllers.chat_controller import get_chat_history
+from db.migrations.add_messages_chat_history_index import migrate
+from db.pg_connection import Base, SessionLocal, engine
+from models.chat import Chat, Message
+
+
+def create_chat(db, n_messages, batch_size=10000):
+    chat_id = uuid.uuid4()
+    db.add(Chat(id=chat_id, url="https://example.com/chat-history-benchmark"))
+    db.commit()
+    start = datetime.datetime(2024, 1, 1)
+    for offset in range(0, n_messages, batch_size):
+        db.bulk_insert_mappings(
+            Message,
+            [
+                {
+                    "id": uuid.uuid4(),
+                    "chat_id": chat_id,
+                    "role": "user" if i % 2 == 0 else "assistant",
+                    "content": f"Message {i} of the benchmark chat",
+                    "created_at": start + datetime.timedelta(seconds=i),
+                }
+                for i in range(offset, min(offset + batch_size, n_messages))
+            ],
+        )
+        db.commit()
+    return chat_id
+
+
+def cursors(db, chat_id, limit, n_messages):
+    """Get the cursors of the first, a middle and the last page."""
+    ids = [
+        row.id
+        for row in db.query(Message.id)
+        .filter(Message.chat_id == chat_id)
+        .order_by(Message.created_at.desc(), Message.id.desc())
+    ]
+    middle = (n_messages // limit // 2) * limit
+    last = (n_messages - 1) // limit * limit
+    return {"first": None, "middle": ids[middle - 1], "last": ids[last - 1]}
+
+
+def measure(function, n_runs):
+    latencies = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        function()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return statistics.median(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    migrate()
+    with SessionLocal() as db:
+        chat_id = create_chat(db, args.messages)
+        try:
+            pages = cursors(db, chat_id, args.limit, args.messages)
+            for page, before in pages.items():
+                p50 = measure(
+                    lambda: get_chat_history(chat_id, db, args.limit, before),
+                    args.runs,
+                )
+                print(f"{page:>6} page: p50 {p50:7.2f} ms")
+            p50 = measure(
+                lambda: db.query(Message)
+                .filter(Message.chat_id == chat_id)
+                .order_by(Message.created_at.desc())
+                .all(),
+                max(args.runs // 10, 1),
+            )
+            print(f"  full history: p50 {p50:7.2f} ms")
+        finally:
+            db.expunge_all()
+            db.query(Message).filter(Message.chat_id == chat_id).delete()
+            db.query(Chat).filter(Chat.id == chat_id).delete()
+            db.commit()
+
+
+if __name__ == "__main__":
+    main()
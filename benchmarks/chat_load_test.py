@@ -0,0 +1,119 @@
+"""
+Load test of the chat endpoint with concurrent questions.
+
+Usage, against the API of docker-compose and a chat with a processed corpus:
+    python benchmarks/chat_load_test.py --chat-id <chat id> --concurrency 8
+
+Sends the same number of questions sequentially and then all at once, and
+reports the wall time of both runs. When the questions are served
+concurrently, the concurrent run takes about as long as its slowest question
+instead of the sum of the latencies of every question.
+
+Then asks one question to the streaming endpoint and reports the time to the
+first event and to the first token of the answer.
+
+Finally reports the LLM calls and tokens per question, from the metrics of
+the API. Run it with SINGLE_GENERATION=false and true to compare the
+latency and the tokens of both pipelines. The counters are per process, so
+run the API with a single worker.
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+QUESTIONS = [
+    "How do I install the library?",
+    "How do I configure authentication?",
+    "What are the available parameters of the client?",
+    "How are errors handled?",
+    "How do I paginate the results?",
+    "Is there an async API?",
+    "How do I set a timeout?",
+    "How do I enable logging?",
+]
+
+
+async def ask(client, url, question):
+    start = time.perf_counter()
+    response = await client.post(url, json={"message": question})
+    response.raise_for_status()
+    return time.perf_counter() - start
+
+
+async def run(base_url, chat_id, concurrency, sequential):
+    url = f"{base_url}/api/v1/chat/{chat_id}"
+    questions = [QUESTIONS[i % len(QUESTIONS)] for i in range(concurrency)]
+    async with httpx.AsyncClient(timeout=300) as client:
+        start = time.perf_counter()
+        if sequential:
+            latencies = [await ask(client, url, q) for q in questions]
+        else:
+            latencies = await asyncio.gather(*(ask(client, url, q) for q in questions))
+        wall = time.perf_counter() - start
+    return wall, latencies
+
+
+async def stream(base_url, chat_id):
+    url = f"{base_url}/api/v1/chat/{chat_id}/stream"
+    first_event = first_token = None
+    start = time.perf_counter()
+    async with httpx.AsyncClient(timeout=300) as client:
+        async with client.stream("POST", url, json={"message": QUESTIONS[0]}) as r:
+            r.raise_for_status()
+            async for line in r.aiter_lines():
+                elapsed = time.perf_counter() - start
+                if line.startswith("event:") and first_event is None:
+                    first_event = elapsed
+                if line == "event: token" and first_token is None:
+                    first_token = elapsed
+    return first_event, first_token, time.perf_counter() - start
+
+
+def llm_usage(base_url):
+    metrics = httpx.get(f"{base_url}/api/v1/metrics").json()
+    return [
+        metrics.get(name, 0)
+        for name in ("llm_calls", "llm_prompt_tokens", "llm_completion_tokens")
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-url", default="http://localhost:8002")
+    parser.add_argument("--chat-id", required=True)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    usage_before = llm_usage(args.base_url)
+    for name, sequential in (("sequential", True), ("concurrent", False)):
+        wall, latencies = asyncio.run(
+            run(args.base_url, args.chat_id, args.concurrency, sequential)
+        )
+        print(
+            f"{name:>10}: {args.concurrency} questions in {wall:6.1f} s, "
+            f"p50 {statistics.median(latencies):5.1f} s, "
+            f"max {max(latencies):5.1f} s, "
+            f"overlap x{sum(latencies) / wall:4.1f}"
+        )
+    first_event, first_token, total = asyncio.run(stream(args.base_url, args.chat_id))
+    print(
+        f"    stream: first event {first_event:5.2f} s, "
+        f"first token {first_token or 0:5.2f} s, done {total:5.1f} s"
+    )
+    n_questions = 2 * args.concurrency + 1
+    calls, prompt_tokens, completion_tokens = (
+        (after - before) / n_questions
+        for before, after in zip(usage_before, llm_usage(args.base_url))
+    )
+    print(
+        f"       llm: {calls:4.1f} calls, {prompt_tokens:7.0f} prompt tokens, "
+        f"{completion_tokens:5.0f} completion tokens per question"
+    )
+
+
+if __name__ == "__main__":
+    main()
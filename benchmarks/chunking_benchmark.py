@@ -0,0 +1,78 @@
+"""
+Benchmark of the chunkers on large pages.
+
+Usage (from the repository root, with the app settings available):
+    PYTHONPATH=app python benchmarks/chunking_benchmark.py [page.html ...]
+
+Saved pages are used as fixtures when given, otherwise synthetic API
+reference pages of increasing size are generated. The token chunker of the
+ingestion is compared with the markdown chunker it replaced.
+"""
+
+import sys
+import time
+from pathlib import Path
+
+from extraction_benchmark import synthetic_page
+from services.chunking import (
+    block_to_markdown,
+    extract_content_from_html,
+    iter_token_chunks,
+)
+
+
+# Character-based markdown chunker used before the token chunker, kept as the
+# baseline of the comparison
+def section_to_markdown(section, level=1):
+    """Converts a hierarchical section to markdown text, recursively."""
+    parts = [block_to_markdown(section), "\n\n"]
+    for child in section.get('children') or []:
+        parts.append(section_to_markdown(child, level + 1))
+    return "".join(parts)
+
+
+def markdown_chunks(sections, max_length=1024):
+    """Converts the hierarchical structure to flat chunks in markdown."""
+    chunks = []
+    current = ""
+    for section in sections:
+        for part in section_to_markdown(section).split('\n\n'):
+            if not part.strip():
+                continue
+            if len(current) + len(part) + 2 > max_length:
+                if current.strip():
+                    chunks.append(current.strip())
+                current = part + '\n\n'
+            else:
+                current += part + '\n\n'
+    if current.strip():
+        chunks.append(current.strip())
+    return chunks
+
+
+CHUNKERS = {
+    "markdown": lambda sections: markdown_chunks(sections, max_length=1024),
+    "tokens": lambda sections: list(iter_token_chunks(sections)),
+}
+
+
+def main(paths):
+    fixtures = {path: Path(path).read_text(encoding="utf-8") for path in paths}
+    if not fixtures:
+        fixtures = {f"synthetic-{n}": synthetic_page(n) for n in (3000, 6000, 12000)}
+    for name, html in fixtures.items():
+        sections = list(extract_content_from_html(html))
+        print(f"{name}: {len(html) / 1e6:.2f} MB")
+        for chunker_name, chunker in CHUNKERS.items():
+            start = time.perf_counter()
+            chunks = chunker(sections)
+            elapsed = time.perf_counter() - start
+            mb_per_s = len(html) / 1e6 / elapsed
+            print(
+                f"  {chunker_name:>8}: {elapsed * 1000:8.1f} ms, "
+                f"{mb_per_s:6.1f} MB/s, {len(chunks)} chunks"
+            )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,61 @@
+"""
+Micro-benchmark of the HTML extraction backends.
+
+Usage (from the repository root, with the app settings available):
+    PYTHONPATH=app python benchmarks/extraction_benchmark.py [page.html ...]
+
+Saved pages are used as fixtures when given, otherwise a synthetic API
+reference page is generated.
+"""
+
+import sys
+import timeit
+from pathlib import Path
+
+from services.chunking import extract_content_from_html
+
+BACKENDS = ["bs4", "lxml"]
+
+
+def synthetic_page(n_entries: int = 2000) -> str:
+    """Generate an API reference page with nested lists and code blocks."""
+    entries = []
+    for i in range(n_entries):
+        entries.append(
+            f"<h3>function_{i}(arg, *, option=None)</h3>"
+            f"<p>Returns the <code>result</code> of operation {i} applied to "
+            "<em>arg</em>, see the <a href='#'>guide</a>.</p>"
+            "<ul><li><p>arg: the input value</p></li>"
+            "<li>option: one of<ul><li>fast</li><li>safe</li></ul></li></ul>"
+            f"<pre><code><span>result</span> = function_{i}(value)\n"
+            "<span>print</span>(result)</code></pre>"
+        )
+    return (
+        "<html><head><script>var x = 1;</script></head><body>"
+        "<nav><a href='/'>Home</a></nav><h1>API reference</h1>"
+        + "".join(entries)
+        + "</body></html>"
+    )
+
+
+def count_blocks(sections) -> int:
+    """Count the sections and their children."""
+    return sum(1 + len(section.get("children", [])) for section in sections)
+
+
+def main(paths):
+    fixtures = {path: Path(path).read_text(encoding="utf-8") for path in paths}
+    if not fixtures:
+        fixtures = {"synthetic": synthetic_page()}
+    for name, html in fixtures.items():
+        print(f"{name}: {len(html) / 1e6:.2f} MB")
+        for backend in BACKENDS:
+            blocks = count_blocks(extract_content_from_html(html, backend))
+            timer = timeit.Timer(lambda: list(extract_content_from_html(html, backend)))
+            loops, _ = timer.autorange()
+            best = min(timer.repeat(repeat=3, number=loops)) / loops
+            print(f"  {backend:>5}: {best * 1000:8.1f} ms/page, {blocks} blocks")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
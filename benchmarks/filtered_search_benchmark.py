@@ -0,0 +1,101 @@
+"""
+Benchmark of the filtered search latency with many tenants in one collection.
+
+Usage, against the Qdrant of docker-compose:
+    python benchmarks/filtered_search_benchmark.py --port 6343
+
+For 1, 100 and 10,000 tenants sharing the same number of points, measures
+the latency of searches filtered by one tenant, without payload index and
+with the tenant keyword index created by services.qdrant.ensure_collection.
+A temporary collection is created and dropped.
+"""
+
+import argparse
+import random
+import statistics
+import time
+
+from qdrant_client import QdrantClient, models
+
+COLLECTION_NAME = "filtered-search-benchmark"
+
+
+def create_collection(client, dimension, indexed):
+    client.recreate_collection(
+        COLLECTION_NAME,
+        vectors_config=models.VectorParams(
+            size=dimension, distance=models.Distance.COSINE
+        ),
+        hnsw_config=models.HnswConfigDiff(m=16, ef_construct=100, payload_m=16),
+        on_disk_payload=True,
+    )
+    if indexed:
+        client.create_payload_index(
+            COLLECTION_NAME,
+            field_name="corpus_id",
+            field_schema=models.KeywordIndexParams(
+                type=models.KeywordIndexType.KEYWORD, is_tenant=True
+            ),
+            wait=True,
+        )
+
+
+def upload(client, n_points, n_tenants, dimension, batch_size=1000):
+    for start in range(0, n_points, batch_size):
+        ids = list(range(start, min(start + batch_size, n_points)))
+        client.upsert(
+            COLLECTION_NAME,
+            points=models.Batch(
+                ids=ids,
+                payloads=[{"corpus_id": f"tenant-{i % n_tenants}"} for i in ids],
+                vectors=[[random.random() for _ in range(dimension)] for _ in ids],
+            ),
+            wait=True,
+        )
+
+
+def measure(client, n_tenants, dimension, n_queries):
+    latencies = []
+    for _ in range(n_queries):
+        tenant = f"tenant-{random.randrange(n_tenants)}"
+        query_filter = models.Filter(
+            must=[
+                models.FieldCondition(
+                    key="corpus_id", match=models.MatchAny(any=[tenant])
+                )
+            ]
+        )
+        vector = [random.random() for _ in range(dimension)]
+        start = time.perf_counter()
+        client.query_points(
+            COLLECTION_NAME, query=vector, query_filter=query_filter, limit=20
+        )
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    return statistics.median(latencies), latencies[int(len(latencies) * 0.95)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6333)
+    parser.add_argument("--points", type=int, default=100000)
+    parser.add_argument("--dimension", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    client = QdrantClient(args.host, port=args.port, timeout=120)
+    for n_tenants in (1, 100, 10000):
+        for indexed in (False, True):
+            create_collection(client, args.dimension, indexed)
+            upload(client, args.points, n_tenants, args.dimension)
+            p50, p95 = measure(client, n_tenants, args.dimension, args.queries)
+            print(
+                f"{n_tenants:>6} tenants, {'with' if indexed else 'without'} "
+                f"index: p50 {p50:6.1f} ms, p95 {p95:6.1f} ms"
+            )
+    client.delete_collection(COLLECTION_NAME)
+
+
+if __name__ == "__main__":
+    main()
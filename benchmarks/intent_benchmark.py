@@ -0,0 +1,132 @@
+"""
+Benchmark of the local intent classifier.
+
+Usage (from the repository root, with the app settings available):
+    PYTHONPATH=app python benchmarks/intent_benchmark.py [--dimension 1024]
+    PYTHONPATH=app python benchmarks/intent_benchmark.py --evaluate
+
+Measures the latency of workflows.intent_classifier.classify_intent once its
+centroids are loaded, with random centroids and queries, so it runs without
+Bedrock. The LLM classification it replaces takes a Bedrock round trip.
+
+With --evaluate, embeds the labelled questions below with Bedrock, none of
+them an example of the centroids, and reports for a range of margins the
+share of questions classified locally, the accuracy of those, and the
+general or code questions sent to clarification. The configured
+INTENT_MIN_MARGIN is marked, pick the one with no such question.
+"""
+
+import argparse
+import random
+import statistics
+import time
+
+from services.bedrock_embeddings import embed_queries
+from services.vectors import normalize
+from workflows import intent_classifier
+
+# Questions labelled with their intent, kept apart from the examples
+LABELLED_QUESTIONS = [
+    ("How do I install it with pip?", "general"),
+    ("Does it support Python 3.12?", "general"),
+    ("How do I set the API key?", "general"),
+    ("What is the default timeout?", "general"),
+    ("How do I enable logging?", "general"),
+    ("Can I use a proxy?", "general"),
+    ("How are errors reported?", "general"),
+    ("What does the max_retries parameter do?", "general"),
+    ("How do I stream the responses?", "general"),
+    ("Is there a sandbox environment?", "general"),
+    ("How do I delete a resource?", "general"),
+    ("Where are the webhooks configured?", "general"),
+    ("How do I update to the latest version?", "general"),
+    ("What are the rate limits?", "general"),
+    ("Which authentication methods are available?", "general"),
+    ("How do I list all the items?", "general"),
+    ("pagination?", "general"),
+    ("install on windows", "general"),
+    ("Why does `client.list(limit=0)` return every item?", "code"),
+    ("I get KeyError: 'data' from resp = api.fetch(); resp['data']", "code"),
+    ("Is this correct? with Client() as c: c.close()", "code"),
+    ("Fix this: async def main(): client.get(url)", "code"),
+    ("What is wrong with `for page in client.pages(): print(page.items[0])`?", "code"),
+    ("Why is config = Config(timeout='30') rejected?", "code"),
+    ("How do I make this faster? [client.get(i) for i in ids]", "code"),
+    ("This raises AttributeError: response.json.items()", "code"),
+    ("Can you rewrite `requests.get(url, verify=False)` with the client?", "code"),
+    ("Why does await client.upload(open('a.txt')) hang?", "code"),
+    ("it fails", "clarification"),
+    ("what?", "clarification"),
+    ("hello", "clarification"),
+    ("and the rest?", "clarification"),
+    ("that one", "clarification"),
+    ("doesn't work", "clarification"),
+    ("more", "clarification"),
+    ("ok but how", "clarification"),
+    ("same error again", "clarification"),
+    ("thanks", "clarification"),
+]
+MARGINS = [0.0, 0.01, 0.02, 0.03, 0.05, 0.08, 0.1, 0.15]
+
+
+def random_vector(dimension):
+    return normalize([random.gauss(0, 1) for _ in range(dimension)])
+
+
+def evaluate():
+    questions = [question for question, _ in LABELLED_QUESTIONS]
+    vectors = [normalize(vector) for vector in embed_queries(questions)]
+    intent_classifier.load_centroids()
+    # Nearest centroid and margin of each question, thresholded below
+    intent_classifier.INTENT_MIN_MARGIN = 0.0
+    predictions = [intent_classifier.classify_intent(vector) for vector in vectors]
+    configured = intent_classifier.settings.intent_min_margin
+    print("margin  local  accuracy  sent to clarification")
+    for margin in sorted(set(MARGINS + [configured])):
+        local = [
+            (intent, label)
+            for (intent, score), (_, label) in zip(predictions, LABELLED_QUESTIONS)
+            if score >= margin
+        ]
+        correct = sum(intent == label for intent, label in local)
+        clarification = sum(
+            intent == "clarification" and label != "clarification"
+            for intent, label in local
+        )
+        print(
+            f"{margin:6.2f}  {len(local) / len(predictions):5.0%}  "
+            f"{correct / len(local) if local else 1.0:8.0%}  {clarification:21d}"
+            f"{'  <- INTENT_MIN_MARGIN' if margin == configured else ''}"
+        )
+    for (intent, score), (question, label) in zip(predictions, LABELLED_QUESTIONS):
+        if intent != label and score >= configured:
+            print(f"Misclassified as {intent} ({score:.3f}): {question!r} ({label})")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dimension", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--evaluate", action="store_true")
+    args = parser.parse_args()
+
+    if args.evaluate:
+        evaluate()
+        return
+    for intent in intent_classifier.INTENT_EXAMPLES:
+        intent_classifier.centroids[intent] = random_vector(args.dimension)
+    queries = [random_vector(args.dimension) for _ in range(args.queries)]
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        intent_classifier.classify_intent(query)
+        latencies.append((time.perf_counter() - start) * 1e6)
+    latencies.sort()
+    print(
+        f"classify_intent: p50 {statistics.median(latencies):6.1f} us, "
+        f"p95 {latencies[int(len(latencies) * 0.95)]:6.1f} us"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Benchmark of the Qdrant upload modes, in points per second.
+
+Usage, against the Qdrant of docker-compose:
+    python benchmarks/qdrant_upload_benchmark.py --port 6343 --grpc-port 6344
+
+Compares the previous upload (sequential HTTP batches of 2000 points waiting
+for each one) with the bulk mode of services.qdrant.store_points (gRPC,
+parallel batches, waiting only for the last one). A temporary collection is
+created and dropped.
+"""
+
+import argparse
+import random
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from qdrant_client import QdrantClient, models
+
+COLLECTION_NAME = "upload-benchmark"
+
+
+def random_points(n_points: int, dimension: int):
+    ids = [str(uuid.uuid4()) for _ in range(n_points)]
+    payloads = [
+        {"text": f"chunk {i}", "url": "https://example.com", "corpus_id": "c"}
+        for i in range(n_points)
+    ]
+    vectors = [[random.random() for _ in range(dimension)] for _ in range(n_points)]
+    return ids, payloads, vectors
+
+
+def upsert(client, ids, payloads, vectors, wait):
+    client.upsert(
+        collection_name=COLLECTION_NAME,
+        points=models.Batch(ids=ids, payloads=payloads, vectors=vectors),
+        wait=wait,
+    )
+
+
+def sequential_upload(client, ids, payloads, vectors, batch_size=2000):
+    for i in range(0, len(ids), batch_size):
+        s = slice(i, i + batch_size)
+        upsert(client, ids[s], payloads[s], vectors[s], wait=True)
+
+
+def bulk_upload(client, ids, payloads, vectors, batch_size=256, workers=4):
+    slices = [slice(i, i + batch_size) for i in range(0, len(ids), batch_size)]
+    last = slices.pop()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(upsert, client, ids[s], payloads[s], vectors[s], False)
+            for s in slices
+        ]
+        for future in futures:
+            future.result()
+    upsert(client, ids[last], payloads[last], vectors[last], wait=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6333)
+    parser.add_argument("--grpc-port", type=int, default=6334)
+    parser.add_argument("--points", type=int, default=20000)
+    parser.add_argument("--dimension", type=int, default=1024)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    http_client = QdrantClient(args.host, port=args.port, timeout=60)
+    grpc_client = QdrantClient(
+        args.host, port=args.port, grpc_port=args.grpc_port, prefer_grpc=True
+    )
+    ids, payloads, vectors = random_points(args.points, args.dimension)
+    modes = {
+        "sequential http": lambda: sequential_upload(
+            http_client, ids, payloads, vectors
+        ),
+        "bulk grpc": lambda: bulk_upload(
+            grpc_client, ids, payloads, vectors, workers=args.workers
+        ),
+    }
+    for name, upload in modes.items():
+        http_client.recreate_collection(
+            COLLECTION_NAME,
+            vectors_config=models.VectorParams(
+                size=args.dimension, distance=models.Distance.COSINE
+            ),
+        )
+        start = time.perf_counter()
+        upload()
+        elapsed = time.perf_counter() - start
+        count = http_client.count(COLLECTION_NAME, exact=True).count
+        print(
+            f"{name:>16}: {args.points / elapsed:8.0f} points/s "
+            f"({elapsed:.2f} s, {count} points stored)"
+        )
+    http_client.delete_collection(COLLECTION_NAME)
+
+
+if __name__ == "__main__":
+    main()
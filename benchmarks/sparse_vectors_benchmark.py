@@ -0,0 +1,40 @@
+"""
+Benchmark of the sparse vectors computed at ingestion.
+
+Usage (from the repository root, with the app settings available):
+    PYTHONPATH=app python benchmarks/sparse_vectors_benchmark.py [page.html ...]
+
+Chunks saved pages, or a synthetic API reference page, and measures the time
+to compute the BM25 sparse vectors of the chunks, to compare with the time
+to embed them.
+"""
+
+import sys
+import time
+from pathlib import Path
+
+from extraction_benchmark import synthetic_page
+from services.chunking import extract_content_from_html, iter_token_chunks
+from services.sparse_vectors import document_sparse_vector
+
+
+def main(paths):
+    fixtures = {path: Path(path).read_text(encoding="utf-8") for path in paths}
+    if not fixtures:
+        fixtures = {"synthetic": synthetic_page(6000)}
+    for name, html in fixtures.items():
+        chunks = list(iter_token_chunks(extract_content_from_html(html)))
+        texts = ["\n".join(c["headings"] + [c["content"]]) for c in chunks]
+        start = time.perf_counter()
+        vectors = [document_sparse_vector(text) for text in texts]
+        elapsed = time.perf_counter() - start
+        terms = sum(len(vector.indices) for vector in vectors) / len(vectors)
+        print(
+            f"{name}: {len(texts)} chunks in {elapsed * 1000:7.1f} ms, "
+            f"{elapsed / len(texts) * 1e6:6.1f} us per chunk, "
+            f"{terms:5.1f} terms per chunk"
+        )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])